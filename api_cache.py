@@ -0,0 +1,49 @@
+"""
+Small in-process TTL + LRU cache for serialized API responses.
+
+Entries are keyed by the response ETag, which already includes the data
+validator (e.g. the newest updated_at), so a stale entry can never be served;
+writes still clear the cache to release memory early.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """Thread-safe mapping of key -> value with a TTL and a size bound"""
+
+    def __init__(self, max_entries=256, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,18 +1,41 @@
+import hashlib
 import json
 import logging
 import os
+import re
 import subprocess
-import yaml
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+
+import click
+from flask import Flask, Response, abort, render_template, request, redirect, url_for, flash, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import DeclarativeBase, load_only
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Build log reads on the detail page and the log API
+LOG_TAIL_SIZE = 64 * 1024
+LOG_PAGE_SIZE = 64 * 1024
+LOG_MAX_PAGE_SIZE = 1024 * 1024
+
+# Package search results on /api/packages
+PACKAGE_PAGE_SIZE = 50
+PACKAGE_MAX_PAGE_SIZE = 500
+
+# git ls-remote of feed repositories when hashing a build configuration
+REPO_RESOLVE_TIMEOUT = 15
+# Longest a config submission waits for all of them; slower remotes skip deduplication
+REPO_RESOLVE_BUDGET = 5
+# Resolved (and failed) refs are reused for this many seconds
+REPO_REF_TTL = 60
+# openwrt.yml build options that change how fast a build runs, not what it produces
+BUILD_TUNING_OPTIONS = ('jobs', 'download_jobs', 'download_cache', 'ccache')
+
 # Initialize database
 class Base(DeclarativeBase):
     pass
@@ -36,41 +59,282 @@ db.init_app(app)
 
 # Import models after db is defined
 import models
+import events
+from api_cache import ResponseCache
+from package_index import get_package_index
+from package_resolver import resolve
+from pagination import DEFAULT_LIMIT, InvalidCursor, keyset_paginate
+from config_registry import get_registry
 
 # Create database tables within app context
 with app.app_context():
     db.create_all()
+    # Existing builds are counted before the first status change adjusts the rollup
+    models.BuildStatusCount.seed()
+
+config_registry = get_registry('config')
+event_broker = events.EventBroker(app)
+response_cache = ResponseCache(max_entries=256, ttl=60)
+repo_ref_cache = ResponseCache(max_entries=256, ttl=REPO_REF_TTL)
+repo_resolver = ThreadPoolExecutor(max_workers=8, thread_name_prefix='repo-resolve')
 
 def load_openwrt_config():
-    """Load OpenWrt configuration"""
-    try:
-        with open('config/openwrt.yml', 'r') as f:
-            return yaml.safe_load(f)
-    except Exception as e:
-        logger.error(f"Error loading OpenWrt config: {e}")
-        return {}
+    """Load OpenWrt configuration (cached until the file changes)"""
+    return config_registry.openwrt_config()
 
 def load_packages_config():
-    """Load packages configuration"""
+    """Load packages configuration (cached until the file changes)"""
+    return config_registry.packages_config()
+
+def preflight_check(target, subtarget, openwrt_version, packages, external=()):
+    """Resolve the complete package selection of a build
+    
+    Base packages, the target's include/exclude lists and the selected
+    packages are checked together; packages of custom repositories are not
+    in the package index and are accepted as-is. Returns None when there is
+    no package index to check against.
+    """
+    index = get_package_index(openwrt_version, target, subtarget)
+    if index is None:
+        return None
+    
+    requested = list(load_openwrt_config().get('build', {}).get('base_packages', []))
+    requested += config_registry.include_packages(target, subtarget)
+    requested += packages
+    
+    external = list(external)
+    for repo in load_packages_config().get('repositories', []):
+        external += repo.get('packages', [])
+    
+    return resolve(index, requested, external, config_registry.exclude_packages(target, subtarget))
+
+def resolve_repository_commit(url, branch, auth_token=None):
+    """Return the commit a repository branch or tag points to, or None
+    
+    Results are cached for REPO_REF_TTL seconds, failures as well, so a
+    slow or unreachable remote is not queried on every submission.
+    """
+    if re.fullmatch(r'[0-9a-f]{40}', branch):
+        return branch
+    
+    key = (url, branch, auth_token)
+    cached = repo_ref_cache.get(key)
+    if cached is not None:
+        return cached or None
+    commit = _ls_remote(url, branch, auth_token)
+    repo_ref_cache.set(key, commit or '')
+    return commit
+
+def _ls_remote(url, branch, auth_token):
+    remote = url
+    if auth_token and url.startswith('https://'):
+        remote = f"https://{auth_token}@{url[len('https://'):]}"
     try:
-        with open('config/packages.yml', 'r') as f:
-            return yaml.safe_load(f)
-    except Exception as e:
-        logger.error(f"Error loading packages config: {e}")
-        return {}
+        result = subprocess.run(
+            ['git', 'ls-remote', remote, branch],
+            capture_output=True, text=True, check=True, timeout=REPO_RESOLVE_TIMEOUT,
+            env={**os.environ, 'GIT_TERMINAL_PROMPT': '0'}
+        )
+    except (OSError, subprocess.SubprocessError):
+        # The command line may contain the token, so it is not logged
+        logger.warning(f"Could not resolve {branch} of {url}")
+        return None
+    
+    refs = {}
+    for line in result.stdout.splitlines():
+        commit, ref = line.split('\t', 1)
+        refs[ref] = commit
+    for ref in (branch, f'refs/heads/{branch}', f'refs/tags/{branch}^{{}}', f'refs/tags/{branch}'):
+        if ref in refs:
+            return refs[ref]
+    return None
+
+def build_repositories():
+    """Custom feeds a build gets: packages.yml ones, then the enabled database repositories
+    
+    The same set build.py merges from packages.yml and the --repositories
+    export of the worker.
+    """
+    repositories = [
+        {'name': repo['name'], 'url': repo['url'], 'branch': repo.get('branch') or 'main',
+         'auth_token': repo.get('auth_token'), 'packages': repo.get('packages') or []}
+        for repo in load_packages_config().get('repositories', [])
+        if repo.get('enabled', True) is not False
+    ]
+    for repo in models.Repository.query.filter_by(enabled=True).order_by(models.Repository.name):
+        repositories.append({'name': repo.name, 'url': repo.url, 'branch': repo.branch or 'main',
+                             'auth_token': repo.auth_token, 'packages': repo.packages or []})
+    return repositories
+
+def build_config_hash(target, subtarget, profile, openwrt_version, packages, repositories):
+    """Canonical sha256 of everything that determines the output of a build
+    
+    packages is the requested package list, repositories a list of dicts with
+    name, url, branch, auth_token and packages (see build_repositories). The
+    openwrt.yml build options are included except BUILD_TUNING_OPTIONS. Feed
+    branches are pinned to their current commit; returns None if one cannot
+    be resolved within REPO_RESOLVE_BUDGET seconds, as such a build can not
+    be matched safely.
+    """
+    futures = [
+        repo_resolver.submit(resolve_repository_commit, repo['url'], repo.get('branch') or 'main',
+                             repo.get('auth_token'))
+        for repo in repositories
+    ]
+    # Lookups still running finish in the background and fill the cache
+    _, pending = wait(futures, timeout=REPO_RESOLVE_BUDGET)
+    if pending:
+        logger.warning(f"Feed repositories did not resolve within {REPO_RESOLVE_BUDGET} seconds, "
+                       f"not deduplicating this build")
+        return None
+    commits = [future.result() for future in futures]
+    if None in commits:
+        return None
+    
+    build_options = {
+        name: value for name, value in (load_openwrt_config().get('build') or {}).items()
+        if name not in BUILD_TUNING_OPTIONS
+    }
+    canonical = {
+        'target': target,
+        'subtarget': subtarget,
+        'profile': profile,
+        'openwrt_version': openwrt_version,
+        'packages': sorted(set(packages)),
+        'exclude_packages': sorted(set(config_registry.exclude_packages(target, subtarget))),
+        'build': build_options,
+        # Feed order decides which of two same-named feeds is used, so it is kept
+        'repositories': [
+            [repo['name'], repo['url'], repo.get('branch') or 'main', commit,
+             sorted(set(repo.get('packages') or []))]
+            for repo, commit in zip(repositories, commits)
+        ]
+    }
+    data = json.dumps(canonical, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def update_build_status(build, status):
+    """Change a build's status and publish the transition to live viewers"""
+    if status == build.status:
+        return
+    build.set_status(status)
+    build.updated_at = datetime.utcnow()
+    events.publish_status(build)
+
+def append_build_log(build, data):
+    """Append output to a build log and publish it to live viewers"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    log_size = build.append_log(data)
+    events.publish_log(build, log_size - len(data), data)
+    return log_size
+
+def filter_builds(query, status=None, target=None):
+    """Apply the status/target filters of the build listings"""
+    if status:
+        query = query.filter_by(status=status)
+    if target:
+        query = query.filter_by(target=target)
+    return query
+
+def requested_fields(default=()):
+    """Heavy build fields opted into with ?fields=, e.g. ?fields=packages,config"""
+    if 'fields' not in request.args:
+        return default
+    return tuple(name.strip() for name in request.args['fields'].split(',') if name.strip())
+
+def keyset_page(query, model):
+    """Page a listing with the after/before/limit request arguments"""
+    try:
+        return keyset_paginate(
+            query, model,
+            after=request.args.get('after'),
+            before=request.args.get('before'),
+            limit=request.args.get('limit', DEFAULT_LIMIT, type=int)
+        )
+    except InvalidCursor as e:
+        abort(400, description=str(e))
+
+def paginated_response(items, pagination):
+    """JSON list response with the next page advertised in the Link header"""
+    response = jsonify(items)
+    if pagination.has_next:
+        args = request.args.to_dict()
+        args.pop('before', None)
+        args['after'] = pagination.next_cursor
+        response.headers['Link'] = f'<{url_for(request.endpoint, _external=True, **args)}>; rel="next"'
+        response.headers['X-Next-Cursor'] = pagination.next_cursor
+    return response
+
+def table_version(model):
+    """Validator of a whole table: newest updated_at and highest id (two index lookups)"""
+    return db.session.execute(select(
+        select(func.max(model.updated_at)).scalar_subquery(),
+        select(func.max(model.id)).scalar_subquery()
+    )).one()
+
+def cached_response(validator, render):
+    """Serve a JSON response with a strong ETag derived from validator
+    
+    Matching If-None-Match requests get a 304 without rendering, other hits
+    are served from the response cache.
+    """
+    etag = hashlib.sha256(repr((request.full_path, tuple(validator))).encode()).hexdigest()[:32]
+    
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        cached = response_cache.get(etag)
+        if cached is None:
+            response = app.make_response(render())
+            if response.status_code != 200:
+                return response
+            headers = {name: value for name, value in response.headers.items()
+                       if name in ('Link', 'X-Next-Cursor')}
+            response_cache.set(etag, (response.get_data(), headers))
+        else:
+            body, headers = cached
+            response = app.response_class(body, mimetype='application/json', headers=headers)
+    
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def event_stream(build_id=None, kinds=None):
+    """Build a text/event-stream response resuming after Last-Event-ID"""
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+    
+    # Requests racing past this check can exceed the cap by a few streams,
+    # which the threads left free absorb
+    if event_broker.full():
+        return Response(
+            f"retry: {events.FULL_RETRY}\n\n", status=503, mimetype='text/event-stream',
+            headers={'Retry-After': str(events.FULL_RETRY // 1000), 'Cache-Control': 'no-cache'}
+        )
+    
+    return Response(
+        stream_with_context(event_broker.stream(build_id, kinds, last_event_id)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 @app.route('/')
 def index():
     """Home page with build status and information"""
     openwrt_config = load_openwrt_config()
-    builds = models.Build.query.order_by(models.Build.created_at.desc()).limit(5).all()
+    builds = models.Build.list_query().order_by(models.Build.created_at.desc()).limit(5).all()
     
-    # Count builds by status
+    # Count builds by status from the rollup table
+    counts = models.BuildStatusCount.counts()
     build_stats = {
-        'success': models.Build.query.filter_by(status='success').count(),
-        'failed': models.Build.query.filter_by(status='failed').count(),
-        'in_progress': models.Build.query.filter_by(status='in_progress').count(),
-        'total': models.Build.query.count()
+        'success': counts.get('success', 0),
+        'failed': counts.get('failed', 0),
+        'in_progress': counts.get('in_progress', 0),
+        'total': sum(counts.values())
     }
     
     # Get latest release
@@ -88,23 +352,11 @@ def index():
 @app.route('/builds')
 def builds():
     """List all builds"""
-    page = request.args.get('page', 1, type=int)
-    per_page = 10
-    
     # Filter by status if provided
     status = request.args.get('status')
     target = request.args.get('target')
     
-    query = models.Build.query
-    
-    if status:
-        query = query.filter_by(status=status)
-    
-    if target:
-        query = query.filter_by(target=target)
-    
-    pagination = query.order_by(models.Build.created_at.desc()).paginate(
-        page=page, per_page=per_page, error_out=False)
+    pagination = keyset_page(filter_builds(models.Build.list_query(), status, target), models.Build)
     
     return render_template(
         'builds.html',
@@ -112,62 +364,120 @@ def builds():
         pagination=pagination,
         status=status,
         target=target,
-        targets=load_openwrt_config().get('targets', []),
+        limit=request.args.get('limit', type=int),
+        targets=config_registry.targets(),
+        last_event_id=events.latest_event_id(),
         now=datetime.now()
     )
 
 @app.route('/releases')
 def releases():
     """List all releases"""
-    page = request.args.get('page', 1, type=int)
-    per_page = 10
-    
-    pagination = models.Release.query.order_by(models.Release.created_at.desc()).paginate(
-        page=page, per_page=per_page, error_out=False)
+    pagination = keyset_page(models.Release.query, models.Release)
     
     return render_template(
         'releases.html',
         releases=pagination.items,
         pagination=pagination,
+        limit=request.args.get('limit', type=int),
         now=datetime.now()
     )
 
 @app.route('/api/builds', methods=['GET'])
 def api_builds():
-    """API endpoint to get builds"""
-    builds = models.Build.query.order_by(models.Build.created_at.desc()).limit(10).all()
-    return jsonify([build.to_dict() for build in builds])
+    """API endpoint to get builds
+    
+    Only summary fields are returned, ?fields=packages,config adds those columns.
+    """
+    def render():
+        fields = requested_fields()
+        query = filter_builds(models.Build.list_query(fields), request.args.get('status'), request.args.get('target'))
+        pagination = keyset_page(query, models.Build)
+        return paginated_response([build.to_dict(fields) for build in pagination.items], pagination)
+    
+    return cached_response(table_version(models.Build), render)
 
 @app.route('/api/releases', methods=['GET'])
 def api_releases():
     """API endpoint to get releases"""
-    releases = models.Release.query.order_by(models.Release.created_at.desc()).limit(10).all()
-    return jsonify([release.to_dict() for release in releases])
+    def render():
+        pagination = keyset_page(models.Release.query, models.Release)
+        return paginated_response([release.to_dict() for release in pagination.items], pagination)
+    
+    return cached_response(table_version(models.Release), render)
 
 @app.route('/build/<int:build_id>')
 def build_detail(build_id):
     """Show build details"""
-    build = models.Build.query.get_or_404(build_id)
+    build = models.Build.list_query(('packages', 'config')).get_or_404(build_id)
+    log_tail, log_offset = build.tail_log(LOG_TAIL_SIZE)
     return render_template(
         'build_detail.html',
         build=build,
+        log_tail=log_tail.decode('utf-8', errors='replace'),
+        log_offset=log_offset,
+        log_end=log_offset + len(log_tail),
+        stages=models.BuildStage.for_build(build),
+        last_event_id=events.latest_event_id(),
         now=datetime.now()
     )
 
 @app.route('/api/build/<int:build_id>', methods=['GET'])
 def api_build(build_id):
     """API endpoint to get build details"""
-    build = models.Build.query.get_or_404(build_id)
-    return jsonify(build.to_dict())
+    def render():
+        fields = requested_fields(default=('packages',))
+        build = models.Build.list_query(fields).get_or_404(build_id)
+        return jsonify(build.to_dict(fields))
+    
+    updated_at = db.session.execute(
+        select(models.Build.updated_at).where(models.Build.id == build_id)
+    ).scalar()
+    if updated_at is None:
+        abort(404)
+    return cached_response((updated_at,), render)
+
+@app.route('/api/build/<int:build_id>/logs', methods=['GET'])
+def api_build_logs(build_id):
+    """API endpoint to read a byte range of a build log"""
+    build = models.Build.list_query().get_or_404(build_id)
+    limit = min(max(request.args.get('limit', LOG_PAGE_SIZE, type=int), 1), LOG_MAX_PAGE_SIZE)
+    
+    tail = request.args.get('tail', type=int)
+    if tail is not None:
+        data, offset = build.tail_log(min(max(tail, 0), LOG_MAX_PAGE_SIZE))
+        next_offset = offset + len(data)
+    else:
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        data, next_offset = build.read_log(offset, limit)
+    
+    size = build.current_log_size()
+    return jsonify({
+        'offset': offset,
+        'next_offset': next_offset,
+        'size': max(size, next_offset),
+        'data': data.decode('utf-8', errors='replace')
+    })
+
+@app.route('/api/builds/stream', methods=['GET'])
+def api_builds_stream():
+    """Server-Sent Events stream of status changes of all builds"""
+    return event_stream(kinds=('status',))
+
+@app.route('/api/build/<int:build_id>/events', methods=['GET'])
+def api_build_events(build_id):
+    """Server-Sent Events stream of status changes and log output of a build"""
+    models.Build.query.options(load_only(models.Build.id)).get_or_404(build_id)
+    return event_stream(build_id=build_id)
 
 @app.route('/config')
 def config():
     """Configuration page for build settings"""
-    openwrt_config = load_openwrt_config()
     packages_config = load_packages_config()
     
-    # Get all targets from the config
-    targets = openwrt_config.get('targets', [])
+    # Only the target list is rendered, subtargets and profiles are fetched
+    # per target from /api/targets/<name>
+    targets = config_registry.targets()
     
     return render_template(
         'config.html',
@@ -198,27 +508,18 @@ def save_config():
         repo_enabled = request.form.getlist('repo_enabled[]')
         repo_packages = request.form.getlist('repo_packages[]')
         
+        # Check the package selection before anything is queued
+        repo_package_names = [pkg.strip() for value in repo_packages for pkg in value.split(',') if pkg.strip()]
+        resolution = preflight_check(target, subtarget, openwrt_version, selected_packages, repo_package_names)
+        if resolution is None:
+            logger.warning(f"No package index for {openwrt_version} {target}/{subtarget}, skipping pre-flight check")
+        elif not resolution.ok and not request.form.get('ignore_preflight'):
+            flash('Package pre-flight check failed: ' + '; '.join(resolution.errors()), 'danger')
+            return redirect(url_for('config'))
+        
         # Create repositories list for the config
         repositories = []
         
-        # Create a unique build ID
-        build_id = f"{target}_{subtarget}_{int(datetime.now().timestamp())}"
-        
-        # Create a new build entry
-        build = models.Build(
-            build_id=build_id,
-            target=target,
-            subtarget=subtarget,
-            profile=profile,
-            version=build_version,
-            openwrt_version=openwrt_version,
-            status='pending',
-            logs='Build configuration created',
-            packages=selected_packages
-        )
-        db.session.add(build)
-        db.session.flush()  # Get the ID without committing
-        
         # Process and save repositories to the database
         for i in range(len(repo_names)):
             if repo_names[i] and repo_urls[i]:  # Only add if name and URL are provided
@@ -260,6 +561,40 @@ def save_config():
                     del repo_config['auth_token']
                 repositories.append(repo_config)
         
+        # An identical configuration reuses the artifacts of an earlier build
+        requested_packages = list(load_openwrt_config().get('build', {}).get('base_packages', []))
+        requested_packages += config_registry.include_packages(target, subtarget) + selected_packages
+        config_hash = build_config_hash(target, subtarget, profile, openwrt_version,
+                                        requested_packages, build_repositories())
+        existing = models.Build.find_reusable(config_hash)
+        if existing and not request.form.get('force_rebuild'):
+            # Nothing is queued, so the repository changes are not kept either
+            db.session.rollback()
+            flash(f"An identical configuration was already built as {existing.build_id} ({existing.status}). "
+                  f"Showing that build; select \"Force rebuild\" to build it again.", 'info')
+            return redirect(url_for('build_detail', build_id=existing.id))
+        
+        # Create a unique build ID
+        build_id = f"{target}_{subtarget}_{int(datetime.now().timestamp())}"
+        
+        # Create a new build entry
+        build = models.Build(
+            build_id=build_id,
+            target=target,
+            subtarget=subtarget,
+            profile=profile,
+            version=build_version,
+            openwrt_version=openwrt_version,
+            status='pending',
+            packages=selected_packages,
+            config_hash=config_hash
+        )
+        db.session.add(build)
+        models.BuildStatusCount.adjust(build.status, 1)
+        db.session.flush()  # Get the ID without committing
+        events.publish_status(build)
+        append_build_log(build, 'Build configuration created\n')
+        
         # Create config dictionary
         config = {
             'target': target,
@@ -269,8 +604,17 @@ def save_config():
             'build_version': build_version,
             'packages': selected_packages,
             'repositories': repositories,
+            'config_hash': config_hash,
             'created_at': datetime.now().isoformat()
         }
+        if resolution is not None:
+            config['preflight'] = {
+                'ok': resolution.ok,
+                'errors': resolution.errors(),
+                'package_count': len(resolution.packages),
+                'installed_size': resolution.installed_size,
+                'download_size': resolution.download_size
+            }
         
         # Save the complete config to the build
         build.config = config
@@ -283,6 +627,7 @@ def save_config():
             json.dump(config, f, indent=2)
         
         db.session.commit()
+        response_cache.clear()
         
         flash('Build configuration saved successfully. Build has been queued.', 'success')
         return redirect(url_for('builds'))
@@ -421,36 +766,274 @@ def delete_repository(repo_id):
 @app.route('/api/targets', methods=['GET'])
 def api_targets():
     """API endpoint to get available targets"""
-    openwrt_config = load_openwrt_config()
-    return jsonify(openwrt_config.get('targets', []))
+    return cached_response(config_registry.version(), lambda: jsonify(config_registry.targets()))
+
+@app.route('/api/targets/<name>', methods=['GET'])
+def api_target(name):
+    """API endpoint to get the subtargets and profiles of a single target"""
+    def render():
+        target = config_registry.get_target(name)
+        if target is None:
+            return jsonify({'error': f'Unknown target {name}'}), 404
+        
+        return jsonify({
+            'name': target['name'],
+            'subtarget': target['subtarget'],
+            'description': target['description'],
+            'subtargets': list(target['subtargets'].values())
+        })
+    
+    return cached_response(config_registry.version(), render)
 
 @app.route('/api/packages', methods=['GET'])
 def api_packages():
-    """API endpoint to get available packages for a target/subtarget"""
+    """API endpoint to get available packages for a target/subtarget
+    
+    Supports ?q= (prefix match, or substring of name/description with
+    ?mode=substring), ?offset= and ?limit=. The total number of matches is
+    returned in the X-Total-Count header.
+    """
     target = request.args.get('target')
     subtarget = request.args.get('subtarget')
+    openwrt_version = request.args.get('openwrt_version') or load_openwrt_config().get('default_version')
+    if not target or not subtarget:
+        return jsonify({'error': 'target and subtarget are required'}), 400
     
-    # Mock data for now - in a real implementation, this would fetch packages from OpenWrt
-    packages = [
-        {'name': 'luci', 'description': 'OpenWrt Web UI'},
-        {'name': 'curl', 'description': 'URL retrieval utility'},
-        {'name': 'wget', 'description': 'Network utility to retrieve files'},
-        {'name': 'nano', 'description': 'Small editor for config files'},
-        {'name': 'htop', 'description': 'Interactive process viewer'},
-        {'name': 'iperf3', 'description': 'Network bandwidth measuring tool'},
-        {'name': 'vim', 'description': 'VI improved text editor'},
-        {'name': 'tmux', 'description': 'Terminal multiplexer'},
-        {'name': 'kmod-usb-net', 'description': 'USB net support'},
-        {'name': 'luci-app-firewall', 'description': 'Firewall configuration UI'},
-        {'name': 'wireguard', 'description': 'VPN protocol'},
-        {'name': 'openvpn', 'description': 'OpenVPN client/server'}
-    ]
+    index = get_package_index(openwrt_version, target, subtarget)
+    if index is None:
+        return jsonify({'error': f'No package index for OpenWrt {openwrt_version} {target}/{subtarget}'}), 404
+    
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', PACKAGE_PAGE_SIZE, type=int), 1), PACKAGE_MAX_PAGE_SIZE)
+    total, packages = index.search(request.args.get('q', ''), request.args.get('mode', 'prefix'), offset, limit)
+    
+    response = jsonify(packages)
+    response.headers['X-Total-Count'] = str(total)
+    return response
+
+@app.route('/api/packages/resolve', methods=['GET'])
+def api_packages_resolve():
+    """API endpoint to pre-flight check a package selection
+    
+    Takes target, subtarget, openwrt_version and a comma separated
+    packages list; returns the dependency closure, problems and sizes.
+    """
+    target = request.args.get('target')
+    subtarget = request.args.get('subtarget')
+    openwrt_version = request.args.get('openwrt_version') or load_openwrt_config().get('default_version')
+    if not target or not subtarget:
+        return jsonify({'error': 'target and subtarget are required'}), 400
+    
+    packages = [pkg.strip() for pkg in request.args.get('packages', '').split(',') if pkg.strip()]
+    resolution = preflight_check(target, subtarget, openwrt_version, packages)
+    if resolution is None:
+        return jsonify({'error': f'No package index for OpenWrt {openwrt_version} {target}/{subtarget}'}), 404
+    return jsonify(resolution.to_dict())
+
+def _build_status_event(item, builds, created):
+    """Apply a build_status webhook event to a preloaded build"""
+    build_id = item.get('build_id')
+    build = builds[build_id]
+    if build_id not in created and item.get('status'):
+        update_build_status(build, item['status'])
+    created.discard(build_id)
+    
+    # Older reporters send the whole log every time, only store what is new
+    if item.get('logs'):
+        logs = item['logs'].encode('utf-8')
+        append_build_log(build, logs[build.current_log_size():])
     
-    return jsonify(packages)
+    return {'status': 'success', 'message': f'Build {build_id} updated'}
+
+def _build_log_event(item, builds):
+    """Apply a build_log webhook event to a preloaded build"""
+    build_id = item.get('build_id')
+    text = item.get('data', '')
+    
+    build = builds.get(build_id)
+    if not build:
+        return {'status': 'error', 'error': f'Unknown build {build_id}', 'code': 404}
+    
+    # With an offset the append is idempotent: a retried batch only
+    # stores the part that was not written yet
+    offset = item.get('offset')
+    if offset is not None:
+        chunk = text.encode('utf-8')
+        log_size = build.current_log_size()
+        if offset > log_size:
+            return {'status': 'error', 'error': 'Log offset is past the end of the log',
+                    'log_size': log_size, 'code': 409}
+        text = chunk[log_size - offset:]
+    
+    log_size = append_build_log(build, text)
+    return {'status': 'success', 'log_size': log_size}
+
+def _load_builds(items):
+    """Load or create every build referenced by a batch with one IN query each"""
+    build_ids = {item.get('build_id') for item in items
+                 if item.get('event_type') in ('build_status', 'build_log', 'build_stage', 'release_created')
+                 and item.get('build_id')}
+    if not build_ids:
+        return {}, set()
+    
+    query = models.Build.list_query()
+    builds = {build.build_id: build for build in query.filter(models.Build.build_id.in_(build_ids))}
+    
+    # The first build_status event of an unknown build creates it
+    new_rows = {}
+    for item in items:
+        build_id = item.get('build_id')
+        if (item.get('event_type') == 'build_status' and build_id and item.get('status')
+                and build_id not in builds and build_id not in new_rows):
+            new_rows[build_id] = {
+                'build_id': build_id,
+                'target': item.get('target', 'unknown'),
+                'subtarget': item.get('subtarget', 'unknown'),
+                'version': item.get('version', 'unknown'),
+                'status': item['status']
+            }
+    if not new_rows:
+        return builds, set()
+    
+    # Builds inserted concurrently by another request are left alone here
+    # and picked up by the reload below
+    inserted = models.upsert(models.Build, list(new_rows.values()), ['build_id'],
+                             returning=(models.Build.build_id, models.Build.status))
+    created = set()
+    for build_id, status in inserted:
+        models.BuildStatusCount.adjust(status, 1)
+        created.add(build_id)
+    
+    builds.update({build.build_id: build
+                   for build in query.filter(models.Build.build_id.in_(list(new_rows)))})
+    for build_id in created:
+        events.publish_status(builds[build_id])
+    return builds, created
+
+def _upsert_releases(items, builds):
+    """Create or update every release of a batch with a single upsert"""
+    rows = {}
+    listed = set()
+    linked = {}
+    for item in items:
+        if item.get('event_type') == 'release_created' and item.get('version') and item.get('url'):
+            # Same outcome as sequential requests: later events update the
+            # url, and the assets if they list them (a republished release)
+            row = rows.setdefault(item['version'], {'version': item['version'], 'assets': []})
+            row['url'] = item['url']
+            row['updated_at'] = datetime.utcnow()
+            if item.get('assets') is not None:
+                row['assets'] = item['assets']
+                listed.add(item['version'])
+            if item.get('build_id') in builds:
+                linked[item['version']] = builds[item['build_id']].id
+    
+    # An event without an asset list keeps the stored one
+    for versions, columns in ((listed, ['url', 'assets', 'updated_at']), (set(rows) - listed, ['url', 'updated_at'])):
+        if versions:
+            models.upsert(models.Release, [rows[version] for version in sorted(versions)], ['version'], update=columns)
+    
+    # The build whose artifacts were published, e.g. for the download button
+    for version, build_id in linked.items():
+        db.session.execute(update(models.Release).where(models.Release.version == version).values(build_id=build_id))
+
+def _parse_timestamp(value):
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+def _upsert_stages(items, builds):
+    """Store the build_stage events of a batch, a later report of a stage replaces an earlier one"""
+    rows = {}
+    for item in items:
+        build = builds.get(item.get('build_id'))
+        if item.get('event_type') != 'build_stage' or not build or not item.get('stage') or not item.get('status'):
+            continue
+        rows[(build.id, item['stage'])] = {
+            'build_id': build.id,
+            'name': item['stage'],
+            'position': item.get('position') or 0,
+            'status': item['status'],
+            'started_at': _parse_timestamp(item.get('started_at')),
+            'wall_time': item.get('wall_time'),
+            'cpu_time': item.get('cpu_time'),
+            'peak_rss': item.get('peak_rss'),
+            'updated_at': datetime.utcnow()
+        }
+    if rows:
+        models.upsert(models.BuildStage, list(rows.values()), ['build_id', 'name'],
+                      update=['position', 'status', 'started_at', 'wall_time', 'cpu_time', 'peak_rss', 'updated_at'])
+
+# Types of the fields of each webhook event, all of them optional
+EVENT_FIELDS = {
+    'build_status': {'build_id': str, 'status': str, 'logs': str, 'target': str, 'subtarget': str, 'version': str},
+    'build_log': {'build_id': str, 'data': str, 'offset': int},
+    'build_stage': {'build_id': str, 'stage': str, 'status': str, 'position': int, 'started_at': str,
+                    'wall_time': (int, float), 'cpu_time': (int, float), 'peak_rss': int},
+    'release_created': {'build_id': str, 'version': str, 'url': str, 'assets': list},
+}
+
+def _invalid_field(item):
+    """Name of the first field of an event with a value of the wrong type, or None"""
+    for name, types in EVENT_FIELDS.get(item.get('event_type'), {}).items():
+        value = item.get(name)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, types)):
+            return name
+    if item.get('event_type') == 'build_log' and (item.get('offset') or 0) < 0:
+        return 'offset'
+    return None
+
+def process_webhook_events(items):
+    """Apply a list of webhook events in one transaction, returns one result per event"""
+    # A malformed event is rejected on its own, the rest of the batch is applied
+    invalid = {}
+    for index, item in enumerate(items):
+        field = _invalid_field(item)
+        if field:
+            invalid[index] = field
+    valid = [item for index, item in enumerate(items) if index not in invalid]
+    
+    builds, created = _load_builds(valid)
+    _upsert_releases(valid, builds)
+    _upsert_stages(valid, builds)
+    
+    results = []
+    for index, item in enumerate(items):
+        event_type = item.get('event_type')
+        if index in invalid:
+            result = {'status': 'error', 'error': f"Invalid value for {invalid[index]}", 'code': 400}
+        elif event_type == 'build_status':
+            if item.get('build_id') in builds:
+                result = _build_status_event(item, builds, created)
+            else:
+                result = {'status': 'error', 'error': 'build_id and status are required', 'code': 400}
+        elif event_type == 'build_log':
+            result = _build_log_event(item, builds)
+        elif event_type == 'build_stage':
+            if item.get('build_id') not in builds:
+                result = {'status': 'error', 'error': f"Unknown build {item.get('build_id')}", 'code': 404}
+            elif item.get('stage') and item.get('status'):
+                result = {'status': 'success', 'message': f"Stage {item['stage']} of build {item['build_id']} recorded"}
+            else:
+                result = {'status': 'error', 'error': 'stage and status are required', 'code': 400}
+        elif event_type == 'release_created':
+            if item.get('version') and item.get('url'):
+                result = {'status': 'success', 'message': f"Release {item['version']} updated"}
+            else:
+                result = {'status': 'error', 'error': 'version and url are required', 'code': 400}
+        else:
+            result = {'status': 'error', 'error': 'Unknown event type', 'code': 400}
+        results.append(result)
+    return results
 
 @app.route('/api/webhook', methods=['POST'])
 def api_webhook():
-    """Webhook endpoint for GitHub Actions to update build status"""
+    """Webhook endpoint for GitHub Actions to update build status
+    
+    Accepts a single event object, or a list of events (also as
+    {"events": [...]}) that is applied in one transaction.
+    """
     # Simple webhook secret validation
     webhook_secret = os.environ.get('WEBHOOK_SECRET')
     if webhook_secret and request.headers.get('X-Webhook-Secret') != webhook_secret:
@@ -460,54 +1043,55 @@ def api_webhook():
     if not data:
         return jsonify({'error': 'No data provided'}), 400
     
-    event_type = data.get('event_type')
+    batch = isinstance(data, list) or 'events' in data
+    items = (data if isinstance(data, list) else data['events']) if batch else [data]
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return jsonify({'error': 'Events must be JSON objects'}), 400
     
-    if event_type == 'build_status':
-        build_id = data.get('build_id')
-        status = data.get('status')
-        
-        # Update or create build status
-        build = models.Build.query.filter_by(build_id=build_id).first()
-        if build:
-            build.status = status
-            build.updated_at = datetime.utcnow()
-            if 'logs' in data:
-                build.logs = data['logs']
-        else:
-            build = models.Build(
-                build_id=build_id,
-                target=data.get('target', 'unknown'),
-                subtarget=data.get('subtarget', 'unknown'),
-                version=data.get('version', 'unknown'),
-                status=status,
-                logs=data.get('logs', '')
-            )
-            db.session.add(build)
-        
+    try:
+        results = process_webhook_events(items)
         db.session.commit()
-        return jsonify({'status': 'success', 'message': f'Build {build_id} updated'})
+        response_cache.clear()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error processing webhook events: {e}")
+        return jsonify({'error': f'Error processing events: {e}'}), 500
     
-    elif event_type == 'release_created':
-        version = data.get('version')
-        url = data.get('url')
-        
-        # Create or update release
-        release = models.Release.query.filter_by(version=version).first()
-        if release:
-            release.url = url
-            release.updated_at = datetime.utcnow()
-        else:
-            release = models.Release(
-                version=version,
-                url=url,
-                assets=data.get('assets', [])
-            )
-            db.session.add(release)
-        
-        db.session.commit()
-        return jsonify({'status': 'success', 'message': f'Release {version} updated'})
+    if batch:
+        for index, result in enumerate(results):
+            result['index'] = index
+            result.pop('code', None)
+        return jsonify({'results': results})
     
-    return jsonify({'error': 'Unknown event type'}), 400
+    result = results[0]
+    if result['status'] == 'error':
+        code = result.pop('code')
+        return jsonify({key: value for key, value in result.items() if key != 'status'}), code
+    return jsonify(result)
+
+@app.cli.command('rebuild-status-counts')
+def rebuild_status_counts():
+    """Recompute the build_status_counts rollup from the build table"""
+    counts = models.BuildStatusCount.rebuild()
+    for status, count in sorted(counts.items()):
+        print(f"{status}: {count}")
+
+@app.cli.command('prune-events')
+def prune_events():
+    """Delete live build events older than the retention period"""
+    count = events.prune()
+    db.session.commit()
+    print(f"Deleted {count} build events")
+
+@app.cli.command('build-worker')
+@click.option('--concurrency', type=int, default=None, help='Builds to run at once (default: from cores and RAM)')
+@click.option('--command', default=None, help='Build command template, e.g. a fake build for testing')
+@click.option('--work-dir', default=None, help='Directory for the per-build working trees')
+@click.option('--once', is_flag=True, help='Exit once the queue is empty and all builds have finished')
+def run_build_worker(concurrency, command, work_dir, once):
+    """Claim pending builds and run them on this host"""
+    from build_worker import BuildWorker
+    BuildWorker(concurrency=concurrency, command=command, work_dir=work_dir).run(once=once)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,163 @@
+"""
+Collection of build artifacts from an OpenWrt bin/ directory.
+
+Files are selected by include/exclude globs on their path relative to the
+source directory, subdirectories included. They are placed without
+copying data where possible: a hardlink on the same filesystem, else a
+reflink, else an in-kernel copy (copy_file_range, then sendfile). A JSON
+manifest lists every artifact with its size and the sha256 OpenWrt
+already wrote to sha256sums, so later steps need not read the images.
+"""
+
+import fcntl
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INCLUDE = ('*.bin', '*.img', '*.img.gz', '*.itb', '*.buildinfo', '*.manifest', 'sha256sums')
+DEFAULT_EXCLUDE = ()
+
+MANIFEST_NAME = 'artifacts.json'
+
+# ioctl of Linux that shares the extents of one file with another
+FICLONE = 0x40049409
+
+
+def matches(path, include, exclude):
+    return (any(fnmatch.fnmatch(path, pattern) for pattern in include)
+            and not any(fnmatch.fnmatch(path, pattern) for pattern in exclude))
+
+
+def find_artifacts(directory, include=DEFAULT_INCLUDE, exclude=DEFAULT_EXCLUDE):
+    """Sorted paths, relative to directory, of the files matching the globs"""
+    found = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name), directory).replace(os.sep, '/')
+            if matches(path, include, exclude):
+                found.append(path)
+    return sorted(found)
+
+
+def read_sha256sums(directory):
+    """{relative path: sha256} from OpenWrt's sha256sums, empty if there is none"""
+    sums = {}
+    try:
+        with open(os.path.join(directory, 'sha256sums')) as f:
+            for line in f:
+                parts = line.split(None, 1)
+                if len(parts) == 2:
+                    # "<hash> *<name>", the * marks binary mode
+                    name = parts[1].strip().lstrip('*')
+                    if name.startswith('./'):
+                        name = name[2:]
+                    sums[name] = parts[0].lower()
+    except OSError:
+        pass
+    return sums
+
+
+def _kernel_copy(src, dst):
+    """Copy file data inside the kernel, returns the method used"""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return 'reflink'
+        except OSError:
+            pass
+
+        size = os.fstat(fsrc.fileno()).st_size
+        for method in ('copy_file_range', 'sendfile'):
+            offset = 0
+            try:
+                while offset < size:
+                    if method == 'copy_file_range':
+                        copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - offset,
+                                                    offset, offset)
+                    else:
+                        os.lseek(fdst.fileno(), offset, os.SEEK_SET)
+                        copied = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+                    if not copied:
+                        break
+                    offset += copied
+            except (OSError, AttributeError):
+                continue
+            if offset == size:
+                return method
+
+        fsrc.seek(0)
+        fdst.seek(0)
+        fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst)
+        return 'copy'
+
+
+def place(src, dst):
+    """Put src at dst as cheaply as possible, returns the method used"""
+    if os.path.exists(dst):
+        if os.path.samefile(src, dst):
+            return 'existing'
+        os.remove(dst)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev:
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            pass
+    method = _kernel_copy(src, dst)
+    shutil.copystat(src, dst)
+    return method
+
+
+def _hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def collect(src_dir, dst_dir, include=DEFAULT_INCLUDE, exclude=DEFAULT_EXCLUDE, metadata=None):
+    """Place the matching files of src_dir in dst_dir and write the manifest, returns it"""
+    sums = read_sha256sums(src_dir)
+    artifacts = []
+    methods = {}
+    for path in find_artifacts(src_dir, include, exclude):
+        src = os.path.join(src_dir, path)
+        method = place(src, os.path.join(dst_dir, path))
+        methods[method] = methods.get(method, 0) + 1
+        # Only files OpenWrt did not checksum (sha256sums itself) are read
+        sha256 = sums.get(path) or _hash_file(src)
+        artifacts.append({'name': path, 'size': os.path.getsize(src), 'sha256': sha256})
+    logger.info(f"Collected {len(artifacts)} artifacts from {src_dir}: "
+                + (', '.join(f"{count} {method}" for method, count in sorted(methods.items())) or 'none'))
+
+    manifest = {**(metadata or {}), 'artifacts': artifacts}
+    tmp_path = os.path.join(dst_dir, f"{MANIFEST_NAME}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(dst_dir, MANIFEST_NAME))
+    return manifest
+
+
+def detach(directory):
+    """Unlink the files of directory that are hardlinked elsewhere
+
+    A rebuild then writes new files instead of changing artifacts collected
+    earlier in place.
+    """
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if os.lstat(path).st_nlink > 1:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
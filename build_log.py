@@ -0,0 +1,275 @@
+"""
+Streaming capture of build command output.
+
+Output is read line by line and never held in full: lines go to a gzip
+log on disk, the most recent ones are kept in a ring buffer that gives
+context to detected failures, and a LogShipper sends them to the web
+app's webhook as build_log events in batches bounded by size and age,
+together with other events of the build such as its stage timings.
+Failures are recognized from the messages OpenWrt's make prints
+("ERROR: package/... failed to build", "make[N]: *** ...") and compiler
+errors, and collected into a structured summary.
+"""
+
+import gzip
+import json
+import logging
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Lines kept for failure context
+RING_LINES = 2000
+CONTEXT_LINES = 20
+# Longer lines are split, so one line never takes more memory than this
+MAX_LINE_BYTES = 64 * 1024
+MAX_FAILURES = 50
+
+BATCH_BYTES = 64 * 1024
+BATCH_SECONDS = 2.0
+# Output waiting to be shipped; the build is slowed down rather than buffering more
+MAX_PENDING_BYTES = 4 * 1024 * 1024
+SHIP_RETRIES = 3
+SHIP_TIMEOUT = 30
+
+FAILURE_PATTERNS = (
+    ('package', re.compile(r'^ERROR: (?P<target>\S+) failed to build')),
+    ('make', re.compile(r'^make(?:\[(?P<level>\d+)\])?: \*\*\* (?P<message>.+)')),
+    ('compiler', re.compile(r'^(?P<file>[^\s:]+):(?P<source_line>\d+):(?:\d+:)? (?:fatal )?error: (?P<message>.+)')),
+)
+
+
+def match_failure(line):
+    """(kind, match) of an output line that reports a failure, or None"""
+    for kind, pattern in FAILURE_PATTERNS:
+        match = pattern.match(line)
+        if match:
+            return kind, match
+    return None
+
+
+class LogShipper:
+    """Sends output (as build_log events) and other build events to the webhook from a background thread"""
+
+    def __init__(self, url, build_id, secret=None, batch_bytes=BATCH_BYTES, batch_seconds=BATCH_SECONDS):
+        self.url = url
+        self.build_id = build_id
+        self.secret = secret
+        self.batch_bytes = batch_bytes
+        self.batch_seconds = batch_seconds
+        self.shipped = 0
+        self.failed_batches = 0
+        self._pending = []
+        self._pending_size = 0
+        self._pending_since = None
+        self._events = []
+        self._offset = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, text):
+        data = text.encode('utf-8')
+        with self._cond:
+            while self._pending_size >= MAX_PENDING_BYTES and not self._closed:
+                self._cond.wait()
+            first = not self._pending and not self._events
+            if first:
+                self._pending_since = time.monotonic()
+            self._pending.append(data)
+            self._pending_size += len(data)
+            # Wake the sender to start the age timer or send a full batch
+            if first or self._pending_size >= self.batch_bytes:
+                self._cond.notify_all()
+
+    def add_event(self, event):
+        """Queue a webhook event of this build, it goes out with the next batch"""
+        with self._cond:
+            if not self._pending and not self._events:
+                self._pending_since = time.monotonic()
+                self._cond.notify_all()
+            self._events.append({**event, 'build_id': self.build_id})
+    
+    def _take_batch(self):
+        """Wait until a batch is due, returns its data and events (nothing once closed and drained)"""
+        with self._cond:
+            while True:
+                if self._pending or self._events:
+                    age = time.monotonic() - self._pending_since
+                    if self._closed or self._pending_size >= self.batch_bytes or age >= self.batch_seconds:
+                        break
+                    self._cond.wait(self.batch_seconds - age)
+                elif self._closed:
+                    return b'', []
+                else:
+                    self._cond.wait()
+            data, events = b''.join(self._pending), self._events
+            self._pending, self._pending_size, self._pending_since, self._events = [], 0, None, []
+            self._cond.notify_all()
+            return data, events
+
+    def _post(self, event):
+        """POST one webhook event (or a list of them), retrying with backoff; returns the response or None"""
+        body = json.dumps(event).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.secret:
+            headers['X-Webhook-Secret'] = self.secret
+        for attempt in range(SHIP_RETRIES):
+            request = urllib.request.Request(self.url, data=body, headers=headers, method='POST')
+            try:
+                with urllib.request.urlopen(request, timeout=SHIP_TIMEOUT) as response:
+                    return json.load(response)
+            except urllib.error.HTTPError as e:
+                # The webhook answers a bad offset with 409 and the current size
+                if e.code == 409:
+                    try:
+                        return json.load(e)
+                    except ValueError:
+                        return None
+                if e.code < 500:
+                    logger.warning(f"Webhook rejected build output: HTTP {e.code}")
+                    return None
+            except (OSError, ValueError) as e:
+                logger.debug(f"Shipping build output failed: {e}")
+            time.sleep(2 ** attempt)
+        return None
+
+    def _send(self, data):
+        if self._offset is None:
+            # An empty append tells where the build's log currently ends
+            response = self._post({'event_type': 'build_log', 'build_id': self.build_id, 'data': ''})
+            if response is None or 'log_size' not in response:
+                self.failed_batches += 1
+                return
+            self._offset = response['log_size']
+        text = data.decode('utf-8', errors='replace')
+        for _ in range(2):
+            # With the offset a retried batch is stored only once
+            response = self._post({'event_type': 'build_log', 'build_id': self.build_id,
+                                   'data': text, 'offset': self._offset})
+            if response is not None and 'error' not in response:
+                self._offset = response['log_size']
+                self.shipped += len(data)
+                return
+            if response is None or 'log_size' not in response:
+                break
+            # An earlier batch was lost, continue where the stored log ends
+            self._offset = response['log_size']
+        self.failed_batches += 1
+        self._offset = None
+
+    def _send_events(self, events):
+        # A list is applied by the webhook in one transaction
+        response = self._post(events)
+        if response is None:
+            self.failed_batches += 1
+            return
+        for event, result in zip(events, response.get('results', [])):
+            if result.get('status') != 'success':
+                logger.warning(f"Webhook rejected {event['event_type']} event: {result.get('error')}")
+    
+    def _run(self):
+        while True:
+            data, events = self._take_batch()
+            if not data and not events:
+                return
+            if events:
+                self._send_events(events)
+            if data:
+                self._send(data)
+
+    def close(self, timeout=60):
+        """Ship what is pending and stop the background thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if self.failed_batches:
+            logger.warning(f"{self.failed_batches} batches of build output could not be shipped")
+
+
+class BuildLog:
+    """Output of a build's commands: gzip log, recent lines, failures and shipping"""
+
+    def __init__(self, path, shipper=None, echo=True):
+        self.path = path
+        self.shipper = shipper
+        self.echo = echo
+        self.lines = 0
+        self.recent = deque(maxlen=RING_LINES)
+        self.failures = []
+        self._file = gzip.open(path, 'wt', encoding='utf-8', compresslevel=6)
+        self._lock = threading.Lock()
+
+    def add(self, line, scan=True, echo=True):
+        """Record one line of output (with its newline)"""
+        with self._lock:
+            self.lines += 1
+            self._file.write(line)
+            if self.echo and echo:
+                sys.stdout.write(line)
+                sys.stdout.flush()
+            if scan:
+                failure = match_failure(line.rstrip('\n'))
+                if failure and len(self.failures) < MAX_FAILURES:
+                    self._add_failure(*failure)
+            self.recent.append(line)
+        if self.shipper:
+            self.shipper.add(line)
+
+    def note(self, text, echo=True):
+        """Add a message of the build script itself, e.g. a stage marker"""
+        for line in text.splitlines():
+            self.add(line + '\n', scan=False, echo=echo)
+
+    def _add_failure(self, kind, match):
+        failure = {'kind': kind, 'log_line': self.lines, 'text': match.group(0).strip()}
+        failure.update({key: value for key, value in match.groupdict().items() if value is not None})
+        failure['context'] = [line.rstrip('\n') for line in list(self.recent)[-CONTEXT_LINES:]]
+        self.failures.append(failure)
+
+    def consume(self, stream):
+        """Read a binary stream (a command's stdout) to its end"""
+        for raw in iter(lambda: stream.readline(MAX_LINE_BYTES), b''):
+            line = raw.decode('utf-8', errors='replace')
+            if not line.endswith('\n'):
+                line += '\n'
+            self.add(line)
+
+    def summary(self):
+        """Structured summary of the failures seen so far"""
+        with self._lock:
+            failures = list(self.failures)
+        packages = list(dict.fromkeys(f['target'] for f in failures if f['kind'] == 'package'))
+        return {
+            'failed_packages': packages,
+            'errors': failures,
+            'lines': self.lines,
+            'log': self.path,
+        }
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        if self.shipper:
+            self.shipper.close()
+
+
+def format_summary(summary, limit=10):
+    """Human readable lines of a failure summary"""
+    lines = []
+    for target in summary['failed_packages']:
+        lines.append(f"Failed to build: {target}")
+    for failure in summary['errors'][:limit]:
+        if failure['kind'] != 'package':
+            lines.append(f"Line {failure['log_line']}: {failure['text']}")
+    if len(summary['errors']) > limit:
+        lines.append(f"... and {len(summary['errors']) - limit} more errors")
+    return lines
@@ -0,0 +1,463 @@
+"""
+Local build worker: claims pending builds from the database and runs them.
+
+Any number of workers, on one host or on several hosts sharing the
+database, can run at once. A build is claimed with a conditional UPDATE
+that only one worker can win, and the claim is kept alive by a heartbeat;
+builds of a worker that stopped heartbeating are put back in the queue.
+Status changes and build output go through process_webhook_events, the same
+code path as /api/webhook, so counters, the response cache and SSE
+subscribers see local builds exactly like GitHub Actions builds.
+
+Builds of one target/subtarget run in the same OpenWrt tree under
+<work_dir>/trees, so the source, feeds and toolchain of earlier builds are
+reused. A tree is locked while a build runs in it; builds whose tree is
+busy stay in the queue. Per-build files live in <work_dir>/builds and are
+removed when the build ends.
+
+Run with `flask --app main build-worker`.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+
+import models
+from app import config_registry, db, process_webhook_events, response_cache
+
+logger = logging.getLogger(__name__)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_COMMAND = ('{python} {script} --target {target} --subtarget {subtarget} '
+                   '--openwrt-version {openwrt_version} --version {version} '
+                   '--config-dir {config_dir} --repositories {repositories} --jobs {jobs} '
+                   '--stage-log {stage_log}')
+
+# Resources one OpenWrt build needs to make progress without thrashing
+CORES_PER_BUILD = 2
+MEMORY_PER_BUILD = 4 * 1024 ** 3
+
+POLL_INTERVAL = 5
+HEARTBEAT_INTERVAL = 30
+STALE_AFTER = 180
+MAX_ATTEMPTS = 3
+STOP_TIMEOUT = 30
+# Pending builds looked at per claim, some may wait for a busy tree
+CLAIM_CANDIDATES = 50
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def default_concurrency():
+    """Number of builds this host can run side by side"""
+    slots = available_cores() // CORES_PER_BUILD
+    memory = available_memory()
+    if memory:
+        slots = min(slots, memory // MEMORY_PER_BUILD)
+    return max(1, slots)
+
+
+class TreeLock:
+    """Exclusive lock on the OpenWrt tree of one target/subtarget
+
+    An flock on <tree>.lock, so it is held against other workers on the host
+    and against other builds of this worker, and dropped if the worker dies.
+    """
+
+    def __init__(self, tree_dir):
+        self.path = tree_dir + '.lock'
+        self._fd = None
+
+    def acquire(self):
+        """Take the lock without waiting, return whether it was free"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class BuildJob:
+    """A claimed build and the process running it"""
+
+    def __init__(self, build, process, log_offset, stage_log=None, scratch_dir=None, tree_lock=None):
+        self.id = build.id
+        self.build_id = build.build_id
+        self.process = process
+        self.log_offset = log_offset
+        self.stage_log = stage_log
+        self.scratch_dir = scratch_dir
+        self.tree_lock = tree_lock
+        self._stage_offset = 0
+        self._output = []
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        for line in self.process.stdout:
+            with self._lock:
+                self._output.append(line)
+
+    def take_output(self):
+        """Output produced since the last call"""
+        with self._lock:
+            output, self._output = ''.join(self._output), []
+        return output
+
+    def take_stages(self):
+        """Stage timing records build.py appended since the last call"""
+        try:
+            with open(self.stage_log, 'rb') as f:
+                f.seek(self._stage_offset)
+                data = f.read()
+        except (OSError, TypeError):
+            return []
+        # Only complete lines, the last one may still be being written
+        data = data[:data.rfind(b'\n') + 1]
+        self._stage_offset += len(data)
+        records = []
+        for line in data.splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logger.warning(f"Ignoring malformed stage record of build {self.build_id}")
+        return records
+
+    def finished(self):
+        if self.process.poll() is None:
+            return False
+        # Let the reader drain what the process wrote before exiting
+        self._reader.join(timeout=5)
+        return True
+
+    def stop(self):
+        """Terminate the build process group, killing it if it does not exit"""
+        if self.process.poll() is not None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            self.process.wait(timeout=STOP_TIMEOUT)
+        except ProcessLookupError:
+            pass
+        except subprocess.TimeoutExpired:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+
+    def close(self):
+        """Unlock the tree and remove the per-build files once the process is gone"""
+        if self.tree_lock:
+            self.tree_lock.release()
+        if self.scratch_dir:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+
+class BuildWorker:
+    """Claims pending builds and runs up to `concurrency` of them at a time"""
+
+    def __init__(self, concurrency=None, command=None, work_dir=None, worker_id=None):
+        self.concurrency = concurrency or int(os.environ.get('BUILD_WORKER_CONCURRENCY', 0)) or default_concurrency()
+        self.command = command or os.environ.get('BUILD_WORKER_COMMAND') or DEFAULT_COMMAND
+        self.work_dir = os.path.abspath(work_dir or os.environ.get('BUILD_WORKER_DIR', 'work'))
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        # make -j for each build, so concurrent builds share the cores
+        self.jobs = max(1, available_cores() // self.concurrency)
+        self.jobs_running = {}
+        self.stopping = False
+        self._last_heartbeat = 0
+
+    def _send(self, items):
+        """Apply webhook events and commit, like a POST to /api/webhook"""
+        try:
+            results = process_webhook_events(items)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        response_cache.clear()
+        return results
+
+    def _status(self, build_id, status, message=None):
+        items = [{'event_type': 'build_status', 'build_id': build_id, 'status': status}]
+        if message:
+            items.append({'event_type': 'build_log', 'build_id': build_id, 'data': message + '\n'})
+        self._send(items)
+
+    def tree_dir(self, target, subtarget):
+        """OpenWrt tree all builds of a target/subtarget on this host run in"""
+        return os.path.join(self.work_dir, 'trees', f"{target}_{subtarget}")
+
+    def scratch_dir(self, build):
+        """Files of one build run (repository export, stage log), removed when it ends"""
+        return os.path.join(self.work_dir, 'builds', build.build_id)
+
+    def claim(self):
+        """Claim the oldest pending build whose tree is free
+
+        Returns the build and the held TreeLock of its tree, or None if there
+        is nothing to run.
+        """
+        Build = models.Build
+        candidates = db.session.execute(
+            select(Build.id, Build.target, Build.subtarget)
+            .where(Build.status == 'pending', Build.worker_id.is_(None))
+            .order_by(Build.created_at, Build.id)
+            .limit(CLAIM_CANDIDATES)
+        ).all()
+
+        for build_id, target, subtarget in candidates:
+            tree_lock = TreeLock(self.tree_dir(target, subtarget))
+            if not tree_lock.acquire():
+                continue
+            # Only one worker sees the row still pending and unclaimed
+            result = db.session.execute(
+                update(Build)
+                .where(Build.id == build_id, Build.status == 'pending', Build.worker_id.is_(None))
+                .values(worker_id=self.worker_id, heartbeat_at=datetime.utcnow(), attempts=Build.attempts + 1)
+            )
+            if result.rowcount != 1:
+                db.session.rollback()
+                tree_lock.release()
+                continue
+
+            build = Build.list_query().populate_existing().filter(Build.id == build_id).one()
+            try:
+                self._send([
+                    {'event_type': 'build_status', 'build_id': build.build_id, 'status': 'in_progress'},
+                    {'event_type': 'build_log', 'build_id': build.build_id,
+                     'data': f"Claimed by worker {self.worker_id} (attempt {build.attempts})\n"}
+                ])
+            except Exception:
+                tree_lock.release()
+                raise
+            return build, tree_lock
+        return None
+
+    def write_repositories(self, cwd):
+        """Export the enabled custom repositories for build.py --repositories"""
+        path = os.path.join(cwd, 'repositories.json')
+        repositories = [
+            {'name': repo.name, 'url': repo.get_url_with_token(), 'branch': repo.branch,
+             'packages': repo.packages or []}
+            for repo in models.Repository.query.filter_by(enabled=True).order_by(models.Repository.name)
+        ]
+        with open(path, 'w') as f:
+            json.dump(repositories, f, indent=2)
+        return path
+
+    def command_for(self, build, repositories, stage_log):
+        values = {
+            'python': sys.executable,
+            'script': os.path.join(REPO_DIR, 'scripts', 'build.py'),
+            'config_dir': config_registry.config_dir,
+            'build_id': build.build_id,
+            'target': build.target,
+            'subtarget': build.subtarget,
+            'openwrt_version': build.openwrt_version or config_registry.openwrt_config().get('default_version'),
+            'version': build.version,
+            'repositories': repositories,
+            'jobs': self.jobs,
+            'stage_log': stage_log,
+        }
+        return [part.format(**values) for part in shlex.split(self.command)]
+
+    def start(self, build, tree_lock):
+        """Run a claimed build in the tree of its target, holding tree_lock
+
+        A build that cannot be started is marked failed right away instead of
+        waiting STALE_AFTER for the claim to go stale.
+        """
+        cwd = self.tree_dir(build.target, build.subtarget)
+        scratch = self.scratch_dir(build)
+        try:
+            os.makedirs(cwd, exist_ok=True)
+            # Records of an earlier attempt are not shipped again
+            shutil.rmtree(scratch, ignore_errors=True)
+            os.makedirs(scratch)
+            stage_log = os.path.join(scratch, 'stages.jsonl')
+            command = self.command_for(build, self.write_repositories(scratch), stage_log)
+            logger.info(f"Starting build {build.build_id}: {' '.join(command)}")
+            process = subprocess.Popen(
+                command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                stdin=subprocess.DEVNULL, text=True, errors='replace', start_new_session=True
+            )
+        except Exception as e:
+            logger.exception(f"Could not start build {build.build_id}")
+            db.session.rollback()
+            tree_lock.release()
+            shutil.rmtree(scratch, ignore_errors=True)
+            self._release(build.id, 'failed', f"Could not start build: {e}")
+            return
+        self.jobs_running[build.id] = BuildJob(build, process, build.log_size, stage_log, scratch, tree_lock)
+
+    def ship_output(self, job):
+        """Append new process output to the build log and store new stage timings"""
+        stages = [{'event_type': 'build_stage', 'build_id': job.build_id, **record}
+                  for record in job.take_stages()]
+        if stages:
+            self._send(stages)
+        output = job.take_output()
+        if not output:
+            return
+        results = self._send([{'event_type': 'build_log', 'build_id': job.build_id,
+                               'data': output, 'offset': job.log_offset}])
+        if results[0]['status'] == 'success':
+            job.log_offset = results[0]['log_size']
+        else:
+            logger.warning(f"Dropped output of build {job.build_id}: {results[0].get('error')}")
+
+    def _release(self, build_id, status, message):
+        """Give up the claim on a build and set its final (or pending) status"""
+        Build = models.Build
+        db.session.execute(
+            update(Build)
+            .where(Build.id == build_id, Build.worker_id == self.worker_id)
+            .values(worker_id=None, heartbeat_at=None)
+        )
+        self._status(db.session.get(Build, build_id).build_id, status, message)
+
+    def reap(self):
+        """Record the outcome of builds whose process has exited"""
+        for build_id, job in list(self.jobs_running.items()):
+            if not job.finished():
+                continue
+            del self.jobs_running[build_id]
+            try:
+                self.ship_output(job)
+            finally:
+                job.close()
+            returncode = job.process.returncode
+            status = 'success' if returncode == 0 else 'failed'
+            logger.info(f"Build {job.build_id} finished with exit code {returncode}")
+            self._release(build_id, status, f"Build process exited with code {returncode}")
+
+    def heartbeat(self):
+        """Refresh the claims of running builds and stop builds whose claim was lost"""
+        if not self.jobs_running:
+            return
+        Build = models.Build
+        ids = list(self.jobs_running)
+        # updated_at is left alone: a heartbeat is not a change API clients care about
+        db.session.execute(
+            update(Build)
+            .where(Build.id.in_(ids), Build.worker_id == self.worker_id)
+            .values(heartbeat_at=datetime.utcnow(), updated_at=Build.updated_at)
+        )
+        db.session.commit()
+
+        owned = set(db.session.execute(
+            select(Build.id).where(Build.id.in_(ids), Build.worker_id == self.worker_id)
+        ).scalars())
+        for build_id in set(ids) - owned:
+            job = self.jobs_running.pop(build_id)
+            logger.warning(f"Lost the claim on build {job.build_id}, stopping it")
+            job.stop()
+            job.close()
+
+    def requeue_stale(self):
+        """Put builds of workers that stopped heartbeating back in the queue"""
+        Build = models.Build
+        cutoff = datetime.utcnow() - timedelta(seconds=STALE_AFTER)
+        stale = db.session.execute(
+            select(Build.id, Build.build_id, Build.worker_id, Build.attempts)
+            .where(Build.status == 'in_progress', Build.worker_id.isnot(None), Build.heartbeat_at < cutoff)
+        ).all()
+
+        for build_id, name, worker_id, attempts in stale:
+            result = db.session.execute(
+                update(Build)
+                .where(Build.id == build_id, Build.worker_id == worker_id, Build.heartbeat_at < cutoff)
+                .values(worker_id=None, heartbeat_at=None)
+            )
+            if result.rowcount != 1:
+                db.session.rollback()
+                continue
+            if attempts >= MAX_ATTEMPTS:
+                self._status(name, 'failed', f"Worker {worker_id} stopped responding, giving up after {attempts} attempts")
+            else:
+                self._status(name, 'pending', f"Worker {worker_id} stopped responding, requeued")
+            logger.warning(f"Requeued stale build {name} of worker {worker_id}")
+
+    def shutdown(self):
+        """Stop running builds and hand them back to the queue"""
+        Build = models.Build
+        for build_id, job in list(self.jobs_running.items()):
+            logger.info(f"Stopping build {job.build_id}")
+            job.stop()
+            self.ship_output(job)
+            job.close()
+            # An interrupted run does not count as an attempt
+            db.session.execute(
+                update(Build).where(Build.id == build_id).values(attempts=Build.attempts - 1)
+            )
+            self._release(build_id, 'pending', f"Worker {self.worker_id} shut down, requeued")
+        self.jobs_running.clear()
+
+    def _handle_signal(self, signum, frame):
+        logger.info(f"Received signal {signum}, shutting down")
+        self.stopping = True
+
+    def run(self, once=False):
+        """Work the queue until a signal arrives (or, with once, until it is empty)"""
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+        logger.info(f"Worker {self.worker_id} running up to {self.concurrency} builds with {self.jobs} jobs each")
+
+        try:
+            while not self.stopping:
+                for job in list(self.jobs_running.values()):
+                    self.ship_output(job)
+                self.reap()
+
+                if time.monotonic() - self._last_heartbeat >= HEARTBEAT_INTERVAL:
+                    self._last_heartbeat = time.monotonic()
+                    self.heartbeat()
+                    self.requeue_stale()
+
+                claimed = False
+                while len(self.jobs_running) < self.concurrency and not self.stopping:
+                    claim = self.claim()
+                    if claim is None:
+                        break
+                    claimed = True
+                    self.start(*claim)
+
+                if once and not claimed and not self.jobs_running:
+                    break
+                time.sleep(1 if self.jobs_running else POLL_INTERVAL)
+        finally:
+            self.shutdown()
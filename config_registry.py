@@ -0,0 +1,206 @@
+"""
+Cached registry for the YAML build configuration.
+
+Config files are parsed once and reloaded when their mtime, size or inode
+changes. Only depends on PyYAML so scripts/build.py can use it as well.
+"""
+
+import logging
+import os
+import threading
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+OPENWRT_CONFIG_FILE = 'openwrt.yml'
+PACKAGES_CONFIG_FILE = 'packages.yml'
+
+
+def _stat_key(path):
+    """Return the (inode, size, mtime_ns) key used to detect file changes"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _unique(items):
+    """Remove duplicates from a list while keeping the original order"""
+    seen = set()
+    result = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            result.append(item)
+    return result
+
+
+def build_target_index(openwrt_config):
+    """Build the target -> subtargets -> profiles index from openwrt.yml"""
+    index = {}
+    for target in openwrt_config.get('targets', []) or []:
+        name = target.get('name')
+        if not name:
+            continue
+
+        subtargets = {}
+        for subtarget in target.get('subtargets', []) or []:
+            subtargets[subtarget['name']] = {
+                'name': subtarget['name'],
+                'description': subtarget.get('description', ''),
+                'profiles': list(subtarget.get('profiles', []) or []),
+            }
+
+        # The default subtarget is always selectable, even if it has no entry
+        # in the subtargets list
+        default_subtarget = target.get('subtarget')
+        if default_subtarget and default_subtarget not in subtargets:
+            subtargets[default_subtarget] = {
+                'name': default_subtarget,
+                'description': 'Default subtarget',
+                'profiles': [],
+            }
+
+        index[name] = {
+            'name': name,
+            'subtarget': default_subtarget,
+            'description': target.get('description', ''),
+            'subtargets': subtargets,
+        }
+    return index
+
+
+def build_package_index(packages_config):
+    """Build the per target_subtarget include/exclude package sets from packages.yml"""
+    include = packages_config.get('include_packages', {}) or {}
+    exclude = packages_config.get('exclude_packages', {}) or {}
+
+    common_include = list(include.get('all', []) or [])
+    common_exclude = list(exclude.get('all', []) or [])
+
+    index = {'all': {'include': _unique(common_include), 'exclude': _unique(common_exclude)}}
+    for key in set(include) | set(exclude):
+        if key == 'all':
+            continue
+        index[key] = {
+            'include': _unique(common_include + list(include.get(key, []) or [])),
+            'exclude': _unique(common_exclude + list(exclude.get(key, []) or [])),
+        }
+    return index
+
+
+class _CachedYaml:
+    """A single YAML file that is re-parsed only when it changes on disk"""
+
+    def __init__(self, path, indexer=None, strict=False):
+        self.path = path
+        self.indexer = indexer
+        self.strict = strict
+        self.data = {}
+        self.index = indexer({}) if indexer else None
+        self.key = None
+
+    def refresh(self):
+        """Reload the file if its stat key changed. Returns True on reload."""
+        key = _stat_key(self.path)
+        if key is not None and key == self.key:
+            return False
+
+        try:
+            with open(self.path, 'r') as f:
+                data = yaml.safe_load(f) or {}
+        except Exception as e:
+            if self.strict:
+                raise
+            logger.error(f"Error loading config {self.path}: {e}")
+            data = {}
+            # Do not remember the key so the next access retries
+            key = None
+
+        self.data = data
+        self.index = self.indexer(data) if self.indexer else None
+        self.key = key
+        return True
+
+
+class ConfigRegistry:
+    """Parsed build configuration with precomputed lookup indexes"""
+
+    def __init__(self, config_dir='config', strict=False):
+        # Resolve now so a later chdir (scripts/build.py) does not break reloads
+        self.config_dir = os.path.abspath(config_dir)
+        self._lock = threading.Lock()
+        self._openwrt = _CachedYaml(os.path.join(self.config_dir, OPENWRT_CONFIG_FILE),
+                                    build_target_index, strict)
+        self._packages = _CachedYaml(os.path.join(self.config_dir, PACKAGES_CONFIG_FILE),
+                                     build_package_index, strict)
+
+    def _get(self, cached):
+        with self._lock:
+            if cached.refresh():
+                logger.debug(f"Loaded config {cached.path}")
+            return cached
+
+    def openwrt_config(self):
+        """Parsed openwrt.yml (shared, do not modify)"""
+        return self._get(self._openwrt).data
+
+    def packages_config(self):
+        """Parsed packages.yml (shared, do not modify)"""
+        return self._get(self._packages).data
+
+    def targets(self):
+        """Target list as written in openwrt.yml"""
+        return self.openwrt_config().get('targets', []) or []
+
+    def target_names(self):
+        return list(self._get(self._openwrt).index)
+
+    def get_target(self, name):
+        """Return a target with its subtargets and profiles, or None"""
+        return self._get(self._openwrt).index.get(name)
+
+    def subtargets(self, target):
+        entry = self.get_target(target)
+        return list(entry['subtargets'].values()) if entry else []
+
+    def profiles(self, target, subtarget):
+        entry = self.get_target(target)
+        if not entry or subtarget not in entry['subtargets']:
+            return []
+        return entry['subtargets'][subtarget]['profiles']
+
+    def _package_set(self, target, subtarget):
+        index = self._get(self._packages).index
+        return index.get(f"{target}_{subtarget}", index['all'])
+
+    def include_packages(self, target, subtarget):
+        """Packages to include for a target/subtarget, common packages first"""
+        return self._package_set(target, subtarget)['include']
+
+    def exclude_packages(self, target, subtarget):
+        """Packages to exclude for a target/subtarget, common packages first"""
+        return self._package_set(target, subtarget)['exclude']
+
+    def version(self):
+        """Stat keys of both config files; changes whenever either file changes"""
+        with self._lock:
+            self._openwrt.refresh()
+            self._packages.refresh()
+            return (self._openwrt.key, self._packages.key)
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(config_dir='config'):
+    """Return the process-wide registry for a configuration directory"""
+    with _registries_lock:
+        registry = _registries.get(config_dir)
+        if registry is None:
+            registry = ConfigRegistry(config_dir)
+            _registries[config_dir] = registry
+        return registry
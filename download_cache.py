@@ -0,0 +1,151 @@
+"""
+Host-wide content-addressed store for OpenWrt source downloads.
+
+Files are stored once under objects/<sha256[:2]>/<sha256> and never
+modified; by-name/<filename> symlinks point at the newest object for a
+file name. by-name/ is handed to OpenWrt as a file:// DOWNLOAD_MIRROR, so
+download.pl takes files from the store before going to the network and
+checks them against the package hash like any other download. Afterwards
+the files in a tree's dl/ are replaced by hardlinks to the objects, so
+every tree and target shares one copy of each tarball.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+
+logger = logging.getLogger(__name__)
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BUFFER_SIZE)
+            if not block:
+                break
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def list_downloads(dl_dir):
+    """{name: (inode, size)} of the finished downloads in a dl/ directory"""
+    files = {}
+    try:
+        entries = os.scandir(dl_dir)
+    except FileNotFoundError:
+        return files
+    with entries:
+        for entry in entries:
+            # Partial downloads and download.pl's hash files are not sources
+            if entry.name.startswith('.') or entry.name.endswith(('.dl', '.hash')):
+                continue
+            if entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                files[entry.name] = (st.st_ino, st.st_size)
+    return files
+
+
+class DownloadCache:
+    """A download store shared by all builds on a host"""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.objects_dir = os.path.join(self.root, 'objects')
+        self.names_dir = os.path.join(self.root, 'by-name')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.names_dir, exist_ok=True)
+
+    @property
+    def mirror(self):
+        """DOWNLOAD_MIRROR value that makes download.pl look in the store first"""
+        return f"file://{self.names_dir}"
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def names(self):
+        """{file name: sha256} of everything in the store"""
+        names = {}
+        with os.scandir(self.names_dir) as entries:
+            for entry in entries:
+                if entry.is_symlink() and not entry.name.endswith('.tmp'):
+                    names[entry.name] = os.path.basename(os.readlink(entry.path))
+        return names
+
+    def _is_cached(self, path, name):
+        """Whether path is already a hardlink to the object stored for name"""
+        try:
+            return os.path.samefile(path, os.path.join(self.names_dir, name))
+        except OSError:
+            return False
+
+    def _store(self, path, digest):
+        """Add a file to the store, returns True if it was new"""
+        target = self.object_path(digest)
+        if os.path.exists(target):
+            return False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_path = f"{target}.{os.getpid()}.tmp"
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            # Another filesystem: the store keeps its own copy
+            logger.debug(f"Cannot hardlink {path} into the download store, copying it")
+            shutil.copyfile(path, tmp_path)
+        os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, target)
+        return True
+
+    def _name(self, name, digest):
+        """Point by-name/<name> at an object"""
+        link = os.path.join(self.names_dir, name)
+        target = os.path.relpath(self.object_path(digest), self.names_dir)
+        if os.path.islink(link) and os.readlink(link) == target:
+            return
+        tmp_link = f"{link}.{os.getpid()}.tmp"
+        os.symlink(target, tmp_link)
+        os.replace(tmp_link, link)
+
+    def _link_into(self, path, digest):
+        """Replace path with a hardlink to its object, if both are on one filesystem"""
+        tmp_path = f"{path}.{os.getpid()}.link"
+        try:
+            os.link(self.object_path(digest), tmp_path)
+        except OSError:
+            return False
+        os.replace(tmp_path, path)
+        return True
+
+    def collect(self, dl_dir, before, known):
+        """Store the files of dl_dir and link them to the store
+
+        before is list_downloads() and known is names() from ahead of the
+        download: files that appeared in dl/ since are counted as hits if
+        the store already had them, otherwise as misses.
+        """
+        stats = {'hits': 0, 'misses': 0, 'hit_bytes': 0, 'miss_bytes': 0, 'stored': 0, 'linked': 0}
+        for name, (inode, size) in sorted(list_downloads(dl_dir).items()):
+            path = os.path.join(dl_dir, name)
+            if self._is_cached(path, name):
+                digest = os.path.basename(os.readlink(os.path.join(self.names_dir, name)))
+            else:
+                digest = hash_file(path)
+                if self._store(path, digest):
+                    stats['stored'] += 1
+                self._name(name, digest)
+                if not os.path.samefile(path, self.object_path(digest)) and self._link_into(path, digest):
+                    stats['linked'] += 1
+
+            if before.get(name) != (inode, size):
+                # download.pl copied it from the file:// mirror if the store had it
+                hit = known.get(name) == digest
+                stats['hits' if hit else 'misses'] += 1
+                stats['hit_bytes' if hit else 'miss_bytes'] += size
+
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else None
+        return stats
@@ -0,0 +1,253 @@
+"""
+Live build events for the Server-Sent Events endpoints.
+
+Events are written to the build_event table in the same transaction as the
+change they describe. Each worker process runs one broker thread that polls
+the table for new rows and fans them out to the SSE connections it serves,
+so any number of gunicorn workers see the same event stream without an
+external message bus, and the event id doubles as the SSE Last-Event-ID.
+Events older than RETENTION are pruned by writers and pollers alike, or
+by `flask prune-events`.
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+
+from app import db
+import models
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.5          # Seconds between broker polls while clients are connected
+HEARTBEAT_INTERVAL = 15      # Seconds between SSE keep-alive comments
+RETENTION = timedelta(hours=1)
+PRUNE_INTERVAL = 300
+BATCH_SIZE = 500
+SUBSCRIBER_QUEUE_SIZE = 1000
+# Ids are assigned before commit, so a concurrent transaction can make a
+# lower id visible after a higher one. Polls look back this many ids.
+LOOKBACK = 100
+# Every open stream holds a worker thread; the rest stay free for pages and
+# the webhook. Defaults to three quarters of gunicorn's threads.
+MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 0)) or max(1, int(os.environ.get('GUNICORN_THREADS', 100)) * 3 // 4)
+# Milliseconds a client turned away at MAX_STREAMS waits before trying again
+FULL_RETRY = 30000
+
+_last_prune = 0
+_prune_lock = threading.Lock()
+
+
+def prune():
+    """Delete events older than RETENTION in the current session, returns how many
+
+    The newest event is always kept: on tables created without
+    AUTOINCREMENT, SQLite would start ids from 1 again once the table is
+    empty, and subscribers and Last-Event-ID resumes skip ids they have seen.
+    """
+    newest = latest_event_id()
+    result = db.session.execute(
+        delete(models.BuildEvent).where(models.BuildEvent.created_at < datetime.utcnow() - RETENTION,
+                                        models.BuildEvent.id < newest)
+    )
+    return result.rowcount
+
+
+def _prune_due():
+    """Whether this process should prune now, at most once per PRUNE_INTERVAL"""
+    global _last_prune
+    with _prune_lock:
+        if time.monotonic() - _last_prune < PRUNE_INTERVAL:
+            return False
+        _last_prune = time.monotonic()
+        return True
+
+
+def publish(kind, data, build=None):
+    """Queue an event in the current session, it is delivered after commit"""
+    event = models.BuildEvent(
+        build_id=build.id if build is not None else None,
+        kind=kind,
+        payload=data
+    )
+    db.session.add(event)
+    # Writers prune as well, the table must not grow while nobody is watching
+    if _prune_due():
+        prune()
+    return event
+
+
+def publish_status(build):
+    """Publish a status transition of a build"""
+    return publish('status', {
+        'id': build.id,
+        'build_id': build.build_id,
+        'target': build.target,
+        'subtarget': build.subtarget,
+        'status': build.status,
+        'updated_at': (build.updated_at or datetime.utcnow()).isoformat()
+    }, build)
+
+
+def publish_log(build, offset, data):
+    """Publish output appended to a build log at the given byte offset"""
+    if isinstance(data, bytes):
+        size = len(data)
+        data = data.decode('utf-8', errors='replace')
+    else:
+        size = len(data.encode('utf-8'))
+    if not size:
+        return None
+    return publish('log', {'id': build.id, 'offset': offset, 'size': size, 'data': data}, build)
+
+
+def latest_event_id():
+    """Id of the newest event, used as the resume point for freshly rendered pages"""
+    return db.session.execute(select(db.func.max(models.BuildEvent.id))).scalar() or 0
+
+
+def format_event(event_id, kind, payload):
+    """Serialize an event in the text/event-stream format"""
+    return f"id: {event_id}\nevent: {kind}\ndata: {json.dumps(payload)}\n\n"
+
+
+class _Subscriber:
+    def __init__(self, build_id, kinds):
+        self.build_id = build_id
+        self.kinds = kinds
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+    def wants(self, build_id, kind):
+        if self.build_id is not None and build_id != self.build_id:
+            return False
+        return self.kinds is None or kind in self.kinds
+
+
+class EventBroker:
+    """Per-process fan-out of new build_event rows to SSE subscribers"""
+
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._thread = None
+        self._last_id = 0
+        self._start_id = 0
+        self._delivered = set()
+        self._delivered_order = deque()
+
+    def subscribe(self, build_id=None, kinds=None):
+        subscriber = _Subscriber(build_id, kinds)
+        with self._lock:
+            self._subscribers.add(subscriber)
+            if self._thread is None or not self._thread.is_alive():
+                # Start from the current end of the table; older events are
+                # replayed per client from its Last-Event-ID
+                self._last_id = self._start_id = latest_event_id()
+                self._delivered.clear()
+                self._delivered_order.clear()
+                self._thread = threading.Thread(target=self._run, name='event-broker', daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def full(self):
+        """Whether this process already serves MAX_STREAMS streams"""
+        with self._lock:
+            return len(self._subscribers) >= MAX_STREAMS
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                with self._lock:
+                    if not self._subscribers:
+                        self._thread = None
+                        break
+                try:
+                    self.poll()
+                except Exception as e:
+                    logger.error(f"Error polling build events: {e}")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+                time.sleep(POLL_INTERVAL)
+
+    def poll(self):
+        """Deliver events newer than the last delivered id to all subscribers"""
+        rows = db.session.execute(
+            select(models.BuildEvent.id, models.BuildEvent.build_id,
+                   models.BuildEvent.kind, models.BuildEvent.payload)
+            .where(models.BuildEvent.id > self._last_id - LOOKBACK)
+            .order_by(models.BuildEvent.id)
+            .limit(BATCH_SIZE + LOOKBACK)
+        ).all()
+
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for row in rows:
+            if row.id <= self._start_id or row.id in self._delivered:
+                continue
+            self._remember(row.id)
+            message = format_event(row.id, row.kind, row.payload)
+            for subscriber in subscribers:
+                if subscriber.overflowed or not subscriber.wants(row.build_id, row.kind):
+                    continue
+                try:
+                    subscriber.queue.put_nowait((row.id, message))
+                except queue.Full:
+                    # A stalled client is dropped, it resumes with Last-Event-ID
+                    subscriber.overflowed = True
+            self._last_id = max(self._last_id, row.id)
+
+        if _prune_due():
+            prune()
+            db.session.commit()
+
+    def _remember(self, event_id):
+        self._delivered.add(event_id)
+        self._delivered_order.append(event_id)
+        while len(self._delivered_order) > LOOKBACK * 2:
+            self._delivered.discard(self._delivered_order.popleft())
+
+    def stream(self, build_id=None, kinds=None, last_event_id=None):
+        """Generate the text/event-stream body for one client"""
+        subscriber = self.subscribe(build_id, kinds)
+        try:
+            # Replay what the client missed; events arriving meanwhile are
+            # queued already and skipped below by id
+            replayed = last_event_id or 0
+            if last_event_id is not None:
+                query = select(models.BuildEvent).where(models.BuildEvent.id > last_event_id)
+                if build_id is not None:
+                    query = query.where(models.BuildEvent.build_id == build_id)
+                if kinds is not None:
+                    query = query.where(models.BuildEvent.kind.in_(kinds))
+                for event in db.session.execute(query.order_by(models.BuildEvent.id)).scalars():
+                    replayed = event.id
+                    yield format_event(event.id, event.kind, event.payload)
+            # Do not hold a pooled connection for the lifetime of the stream
+            db.session.remove()
+
+            yield f"retry: {int(POLL_INTERVAL * 4000)}\n\n"
+            while not subscriber.overflowed:
+                try:
+                    event_id, message = subscriber.queue.get(timeout=HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event_id > replayed:
+                    yield message
+        finally:
+            self.unsubscribe(subscriber)
@@ -0,0 +1,13 @@
+# Gunicorn settings, picked up automatically from the working directory.
+#
+# The SSE endpoints (/api/builds/stream, /api/build/<id>/events) keep one
+# request open per dashboard, so workers must be threaded: every open stream
+# occupies a thread, not a whole worker process. Streams are capped at
+# SSE_MAX_STREAMS per worker (default: three quarters of the threads), so
+# pages and /api/webhook always have threads left; dashboards over the cap
+# get a 503 and retry later. Raise workers or threads for more dashboards.
+import os
+
+worker_class = 'gthread'
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 100))
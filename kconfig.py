@@ -0,0 +1,150 @@
+"""
+In-memory model of an OpenWrt .config.
+
+Symbols are collected from several sources with a fixed precedence: a
+source later in SOURCES overrides an earlier one (recorded in overrides),
+the same value set twice is a harmless duplicate, and one source setting
+two different values is a ConfigConflict. The result is rendered and
+written once, atomically, and two configs can be diffed symbol by symbol.
+"""
+
+import os
+import re
+
+# Sources of symbols, lowest precedence first
+SOURCES = (
+    'target',
+    'build_options',
+    'kernel_config',
+    'base_packages',
+    'include_packages',
+    'repository_packages',
+    'exclude_packages',
+    'version',
+    'file',
+)
+
+PACKAGE_PREFIX = 'CONFIG_PACKAGE_'
+
+_SET_RE = re.compile(r'^(CONFIG_[^=\s]+)=(.*)$')
+_UNSET_RE = re.compile(r'^# (CONFIG_[^=\s]+) is not set$')
+
+
+class ConfigConflict(ValueError):
+    pass
+
+
+def format_value(symbol, value):
+    if value is None:
+        return f"# {symbol} is not set"
+    return f"{symbol}={value}"
+
+
+class Kconfig:
+    """Ordered CONFIG_* symbols with the source that set each of them
+
+    A value of None means "is not set".
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.origins = {}
+        # (symbol, overridden source, overridden value, winning source, winning value)
+        self.overrides = []
+        # (symbol, first source, repeating source)
+        self.duplicates = []
+
+    def set(self, symbol, value, source):
+        if source not in SOURCES:
+            raise ValueError(f"Unknown config source {source}")
+        if not symbol.startswith('CONFIG_'):
+            symbol = f'CONFIG_{symbol}'
+
+        if symbol in self.values:
+            current, origin = self.values[symbol], self.origins[symbol]
+            if current == value:
+                self.duplicates.append((symbol, origin, source))
+                if SOURCES.index(source) > SOURCES.index(origin):
+                    self.origins[symbol] = source
+                return
+            if origin == source:
+                raise ConfigConflict(
+                    f"{source} sets both {format_value(symbol, current)} and {format_value(symbol, value)}"
+                )
+            if SOURCES.index(source) < SOURCES.index(origin):
+                self.overrides.append((symbol, source, value, origin, current))
+                return
+            self.overrides.append((symbol, origin, current, source, value))
+
+        self.values[symbol] = value
+        self.origins[symbol] = source
+
+    def set_line(self, line, source):
+        """Set a symbol from a .config line; comments and blank lines are ignored"""
+        line = line.strip()
+        match = _SET_RE.match(line)
+        if match:
+            self.set(match.group(1), match.group(2), source)
+            return
+        match = _UNSET_RE.match(line)
+        if match:
+            self.set(match.group(1), None, source)
+
+    def select_package(self, name, source):
+        self.set(f'{PACKAGE_PREFIX}{name}', 'y', source)
+
+    def deselect_package(self, name, source):
+        self.set(f'{PACKAGE_PREFIX}{name}', None, source)
+
+    def get(self, symbol):
+        return self.values.get(symbol)
+
+    @classmethod
+    def parse(cls, text, source='file'):
+        config = cls()
+        for line in text.splitlines():
+            config.set_line(line, source)
+        return config
+
+    @classmethod
+    def load(cls, path):
+        """Parse a .config file, or return None if it does not exist"""
+        try:
+            with open(path) as f:
+                return cls.parse(f.read())
+        except FileNotFoundError:
+            return None
+
+    def render(self):
+        return ''.join(f"{format_value(symbol, value)}\n" for symbol, value in self.values.items())
+
+    def write(self, path):
+        """Write the config in one go, replacing path atomically"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def diff(self, other):
+        """{symbol: (other value, own value)} of the symbols that differ
+
+        A symbol missing from one config counts as not set.
+        """
+        changes = {}
+        for symbol in set(self.values) | set(other.values):
+            old, new = other.get(symbol), self.get(symbol)
+            if old != new:
+                changes[symbol] = (old, new)
+        return changes
+
+    def without_packages(self):
+        """Symbols other than package selections, e.g. what the toolchain depends on"""
+        config = Kconfig()
+        for symbol, value in self.values.items():
+            if not symbol.startswith(PACKAGE_PREFIX):
+                config.values[symbol] = value
+                config.origins[symbol] = self.origins[symbol]
+        return config
+
+    def __len__(self):
+        return len(self.values)
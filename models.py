@@ -1,10 +1,75 @@
 from datetime import datetime
 import json
 from app import db
+from sqlalchemy import delete, func, insert, select, tuple_, update
+from sqlalchemy.orm import defer
 from sqlalchemy.types import Text, JSON
 
+def upsert(model, rows, index_elements, update=None, returning=None):
+    """Insert rows, skipping (or updating the update columns of) existing ones
+    
+    Uses INSERT ... ON CONFLICT on SQLite and PostgreSQL and falls back to a
+    SELECT plus per-row writes elsewhere. With returning, the given columns
+    of the rows that were actually inserted are returned.
+    """
+    if not rows:
+        return []
+    
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        
+        stmt = dialect_insert(model).values(rows)
+        if update:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=index_elements,
+                set_={column: stmt.excluded[column] for column in update}
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=index_elements)
+        if returning:
+            return db.session.execute(stmt.returning(*returning)).all()
+        db.session.execute(stmt)
+        return []
+    
+    # Generic fallback, one query for the existing keys
+    key_columns = [getattr(model, name) for name in index_elements]
+    existing = {
+        tuple(row): obj for obj, *row in db.session.execute(
+            select(model, *key_columns).where(
+                tuple_(*key_columns).in_([tuple(r[name] for name in index_elements) for r in rows])
+            )
+        )
+    }
+    inserted = []
+    for row in rows:
+        obj = existing.get(tuple(row[name] for name in index_elements))
+        if obj is None:
+            obj = model(**row)
+            db.session.add(obj)
+            inserted.append(obj)
+        elif update:
+            for column in update:
+                setattr(obj, column, row[column])
+    db.session.flush()
+    if returning:
+        return [tuple(getattr(obj, column.key) for column in returning) for obj in inserted]
+    return []
+
 class Build(db.Model):
     """OpenWrt build model"""
+    __table_args__ = (
+        # Listings are ordered by (created_at, id) and filtered by status or target
+        db.Index('ix_build_created_at_id', 'created_at', 'id'),
+        db.Index('ix_build_status_created_at', 'status', 'created_at'),
+        db.Index('ix_build_target_created_at', 'target', 'created_at'),
+        # max(updated_at) is the ETag validator of the build API
+        db.Index('ix_build_updated_at', 'updated_at'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     build_id = db.Column(db.String(64), unique=True, nullable=False)
     target = db.Column(db.String(64), nullable=False)
@@ -13,16 +78,81 @@ class Build(db.Model):
     version = db.Column(db.String(64), nullable=False)
     openwrt_version = db.Column(db.String(64), nullable=True)
     status = db.Column(db.String(32), nullable=False, default='pending')
-    logs = db.Column(Text, nullable=True)
+    logs = db.Column(Text, nullable=True)  # Legacy full log, new output goes to BuildLogChunk
+    log_size = db.Column(db.Integer, nullable=False, default=0)    # Bytes stored in BuildLogChunk
+    log_chunks = db.Column(db.Integer, nullable=False, default=0)  # Number of BuildLogChunk rows
     packages = db.Column(JSON, nullable=True)  # Selected packages
     config = db.Column(JSON, nullable=True)    # Complete configuration
+    config_hash = db.Column(db.String(64), nullable=True, index=True)  # Canonical hash of the build inputs
+    worker_id = db.Column(db.String(128), nullable=True)   # Local build worker holding the claim
+    heartbeat_at = db.Column(db.DateTime, nullable=True)   # Last heartbeat of that worker
+    attempts = db.Column(db.Integer, nullable=False, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    # Columns that can be megabytes per row and are only loaded on request
+    HEAVY_FIELDS = ('logs', 'packages', 'config')
+    
+    # Builds whose artifacts an identical configuration can reuse
+    REUSABLE_STATUSES = ('success', 'in_progress', 'pending')
+    
     def __repr__(self):
         return f'<Build {self.build_id}>'
     
-    def to_dict(self):
+    @classmethod
+    def list_query(cls, fields=()):
+        """Query for listings that defers the heavy columns not asked for in fields"""
+        return cls.query.options(*[defer(getattr(cls, name)) for name in cls.HEAVY_FIELDS
+                                   if name not in fields])
+    
+    @classmethod
+    def find_reusable(cls, config_hash):
+        """Newest successful or still running build with the same inputs, or None"""
+        if not config_hash:
+            return None
+        return (cls.list_query()
+                .filter(cls.config_hash == config_hash, cls.status.in_(cls.REUSABLE_STATUSES))
+                .order_by((cls.status == 'success').desc(), cls.created_at.desc())
+                .first())
+    
+    def set_status(self, status):
+        """Change the build status and keep the status rollup in sync"""
+        if status == self.status:
+            return
+        if self.status is not None:
+            BuildStatusCount.adjust(self.status, -1)
+        if status is not None:
+            BuildStatusCount.adjust(status, 1)
+        self.status = status
+    
+    def append_log(self, text):
+        """Append new output to the build log"""
+        return BuildLogChunk.append(self, text)
+    
+    def current_log_size(self):
+        """Size of the log in bytes, also for builds that only have the legacy column"""
+        if self.log_chunks:
+            return self.log_size
+        return len((self.logs or '').encode('utf-8'))
+    
+    def read_log(self, offset=0, limit=None):
+        """Read log bytes starting at offset, returns (data, next_offset)"""
+        if not self.log_chunks:
+            # Builds created before the chunk store only have the legacy column,
+            # it is moved to the chunks on the first append
+            data = (self.logs or '').encode('utf-8')
+            end = len(data) if limit is None else offset + limit
+            return data[offset:end], min(end, len(data))
+        return BuildLogChunk.read(self, offset, limit)
+    
+    def tail_log(self, limit):
+        """Read the last limit bytes of the log, returns (data, start_offset)"""
+        start = max(self.current_log_size() - limit, 0)
+        data, _ = self.read_log(start, limit)
+        return data, start
+    
+    def to_summary_dict(self):
+        """Serialize the columns shown in listings, never touches heavy columns"""
         return {
             'id': self.id,
             'build_id': self.build_id,
@@ -32,10 +162,234 @@ class Build(db.Model):
             'version': self.version,
             'openwrt_version': self.openwrt_version,
             'status': self.status,
-            'packages': self.packages,
+            'log_size': self.log_size,
+            'config_hash': self.config_hash,
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat()
         }
+    
+    def to_dict(self, fields=('packages',)):
+        """Serialize the summary plus the requested heavy fields (except logs)"""
+        data = self.to_summary_dict()
+        for name in fields:
+            if name in ('packages', 'config'):
+                data[name] = getattr(self, name)
+        return data
+
+class BuildLogChunk(db.Model):
+    """Append-only, sequence-numbered piece of a build log"""
+    __tablename__ = 'build_log_chunk'
+    __table_args__ = (
+        db.UniqueConstraint('build_id', 'seq'),
+        db.Index('ix_build_log_chunk_offset', 'build_id', 'offset'),
+    )
+    
+    # Large appends are split so range reads never load more than this per row
+    MAX_CHUNK_SIZE = 64 * 1024
+    
+    id = db.Column(db.Integer, primary_key=True)
+    build_id = db.Column(db.Integer, db.ForeignKey('build.id', ondelete='CASCADE'), nullable=False)
+    seq = db.Column(db.Integer, nullable=False)
+    offset = db.Column(db.Integer, nullable=False)  # Byte offset of the chunk in the full log
+    size = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<BuildLogChunk {self.build_id}#{self.seq}>'
+    
+    @classmethod
+    def append(cls, build, text):
+        """Store text after the current end of the build's log, returns the new log size"""
+        data = text.encode('utf-8') if isinstance(text, str) else bytes(text)
+        if not data:
+            return build.current_log_size()
+        
+        pieces = cls._split(data)
+        
+        db.session.flush()
+        if not build.log_chunks and build.logs:
+            cls._adopt_legacy_log(build)
+        
+        # Reserve the byte range and sequence numbers with one atomic UPDATE so
+        # concurrent appenders never hand out the same offset
+        size, chunks = db.session.execute(
+            update(Build)
+            .where(Build.id == build.id)
+            .values(log_size=Build.log_size + len(data), log_chunks=Build.log_chunks + len(pieces))
+            .returning(Build.log_size, Build.log_chunks)
+        ).one()
+        
+        offset = size - len(data)
+        seq = chunks - len(pieces)
+        db.session.execute(insert(cls), [
+            {'build_id': build.id, 'seq': seq + i, 'offset': offset + i * cls.MAX_CHUNK_SIZE,
+             'size': len(piece), 'data': piece, 'created_at': datetime.utcnow()}
+            for i, piece in enumerate(pieces)
+        ])
+        
+        db.session.expire(build, ['log_size', 'log_chunks'])
+        return size
+    
+    @classmethod
+    def _split(cls, data):
+        return [data[i:i + cls.MAX_CHUNK_SIZE] for i in range(0, len(data), cls.MAX_CHUNK_SIZE)]
+    
+    @classmethod
+    def _adopt_legacy_log(cls, build):
+        """Move the legacy Build.logs text into the first chunks, so new output follows it"""
+        data = build.logs.encode('utf-8')
+        pieces = cls._split(data)
+        # Only the appender that still sees no chunks moves the text
+        result = db.session.execute(
+            update(Build)
+            .where(Build.id == build.id, Build.log_chunks == 0)
+            .values(log_size=len(data), log_chunks=len(pieces), logs=None)
+        )
+        if result.rowcount == 1:
+            db.session.execute(insert(cls), [
+                {'build_id': build.id, 'seq': i, 'offset': i * cls.MAX_CHUNK_SIZE,
+                 'size': len(piece), 'data': piece, 'created_at': datetime.utcnow()}
+                for i, piece in enumerate(pieces)
+            ])
+        db.session.expire(build, ['logs', 'log_size', 'log_chunks'])
+    
+    @classmethod
+    def read(cls, build, offset=0, limit=None):
+        """Read log bytes [offset, offset + limit), returns (data, next_offset)"""
+        offset = max(offset, 0)
+        query = select(cls.offset, cls.data).where(
+            cls.build_id == build.id,
+            cls.offset + cls.size > offset
+        )
+        if limit is not None:
+            query = query.where(cls.offset < offset + limit)
+        
+        rows = db.session.execute(query.order_by(cls.seq)).all()
+        if not rows:
+            return b'', offset
+        
+        data = b''.join(row.data for row in rows)
+        start = offset - rows[0].offset
+        end = len(data) if limit is None else start + limit
+        data = data[start:end]
+        return data, offset + len(data)
+
+class BuildStage(db.Model):
+    """Timing of one stage of a build (source, feeds, config, ...), reported by scripts/build.py"""
+    __tablename__ = 'build_stage'
+    __table_args__ = (
+        db.UniqueConstraint('build_id', 'name'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    build_id = db.Column(db.Integer, db.ForeignKey('build.id', ondelete='CASCADE'), nullable=False)
+    name = db.Column(db.String(32), nullable=False)
+    position = db.Column(db.Integer, nullable=False, default=0)  # Order of the stage in the pipeline
+    status = db.Column(db.String(32), nullable=False)            # success, failed or skipped
+    started_at = db.Column(db.DateTime, nullable=True)
+    wall_time = db.Column(db.Float, nullable=True)     # Seconds
+    cpu_time = db.Column(db.Float, nullable=True)      # User + system seconds of the stage's commands
+    peak_rss = db.Column(db.Integer, nullable=True)    # KiB, largest command; None if not above the build script's own RSS
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<BuildStage {self.build_id}:{self.name}>'
+    
+    @classmethod
+    def for_build(cls, build):
+        return cls.query.filter_by(build_id=build.id).order_by(cls.position, cls.id).all()
+    
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'position': self.position,
+            'status': self.status,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'peak_rss': self.peak_rss,
+        }
+
+class BuildEvent(db.Model):
+    """Status change or log output of a build, streamed to dashboards over SSE"""
+    __tablename__ = 'build_event'
+    # Ids must keep growing after old events are pruned, SQLite would
+    # otherwise reuse them once the table is empty
+    __table_args__ = {'sqlite_autoincrement': True}
+    
+    id = db.Column(db.Integer, primary_key=True)  # Used as the SSE event id
+    build_id = db.Column(db.Integer, db.ForeignKey('build.id', ondelete='CASCADE'), nullable=True, index=True)
+    kind = db.Column(db.String(32), nullable=False)
+    payload = db.Column(JSON, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<BuildEvent {self.id} {self.kind}>'
+
+class BuildStatusCount(db.Model):
+    """Number of builds per status, maintained in the same transaction as Build writes"""
+    __tablename__ = 'build_status_counts'
+    
+    status = db.Column(db.String(32), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<BuildStatusCount {self.status}={self.count}>'
+    
+    # Marker row inserted by the first seeding, so a rollup that was never
+    # filled is not mistaken for one without builds
+    SEEDED = '_seeded'
+    
+    @classmethod
+    def adjust(cls, status, delta):
+        """Add delta to the counter of a status, creating the row if needed"""
+        counter = update(cls).where(cls.status == status).values(count=cls.count + delta)
+        if db.session.execute(counter).rowcount:
+            return
+        # A row inserted concurrently by another transaction is updated instead
+        if not upsert(cls, [{'status': status, 'count': delta}], ['status'], returning=(cls.status,)):
+            db.session.execute(counter)
+    
+    @classmethod
+    def seed(cls):
+        """Fill the rollup from the build table if that has never been done
+        
+        Called at startup, before any counter is adjusted. Only the process
+        that inserts the marker row counts the builds.
+        """
+        if db.session.get(cls, cls.SEEDED):
+            return False
+        if not upsert(cls, [{'status': cls.SEEDED, 'count': 0}], ['status'], returning=(cls.status,)):
+            db.session.rollback()
+            return False
+        cls._fill()
+        db.session.commit()
+        return True
+    
+    @classmethod
+    def counts(cls):
+        """Return {status: count}"""
+        return {row.status: row.count
+                for row in db.session.execute(select(cls.status, cls.count).where(cls.status != cls.SEEDED))}
+    
+    @classmethod
+    def _fill(cls):
+        rows = db.session.execute(
+            select(Build.status, func.count(Build.id)).group_by(Build.status)
+        ).all()
+        db.session.execute(delete(cls).where(cls.status != cls.SEEDED))
+        if rows:
+            db.session.execute(insert(cls), [{'status': status, 'count': count} for status, count in rows])
+        return {status: count for status, count in rows}
+    
+    @classmethod
+    def rebuild(cls):
+        """Recompute the rollup from the build table with a single GROUP BY"""
+        upsert(cls, [{'status': cls.SEEDED, 'count': 0}], ['status'])
+        counts = cls._fill()
+        db.session.commit()
+        return counts
 
 class Repository(db.Model):
     """Git repository for custom packages"""
@@ -87,6 +441,11 @@ class Repository(db.Model):
 
 class Release(db.Model):
     """OpenWrt release model"""
+    __table_args__ = (
+        db.Index('ix_release_created_at_id', 'created_at', 'id'),
+        db.Index('ix_release_updated_at', 'updated_at'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     version = db.Column(db.String(64), unique=True, nullable=False)
     url = db.Column(db.String(256), nullable=False)
@@ -0,0 +1,259 @@
+"""
+Index of the packages available for an OpenWrt version/target/subtarget.
+
+Packages are read from opkg `Packages` / `Packages.gz` feed indexes, either
+from a local mirror laid out like downloads.openwrt.org
+(`<mirror>/releases/<version>/...`) or from a build tree's `bin/` directory.
+A parsed index is kept in memory and persisted as a pickle next to the
+instance data, so a restart does not re-parse tens of thousands of stanzas.
+Both caches are invalidated when any source file changes.
+"""
+
+import bisect
+import glob
+import gzip
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+MIRROR_DIR = os.environ.get('PACKAGE_MIRROR_DIR', 'mirror')
+BUILD_BIN_DIR = os.environ.get('OPENWRT_BIN_DIR', os.path.join('openwrt', 'bin'))
+CACHE_DIR = os.path.join('instance', 'package_index')
+
+CACHE_FORMAT = 1
+MAX_INDEXES = 16
+
+# Positions in a package record tuple
+VERSION, SIZE, INSTALLED_SIZE, SECTION, DESCRIPTION, DEPENDS, PROVIDES, CONFLICTS, FEED = range(9)
+
+
+def parse_relations(value):
+    """Parse a Depends-style field into a tuple of alternative groups
+
+    "libc, a (>= 1.0) | b" -> (('libc',), ('a', 'b'))
+    """
+    groups = []
+    for item in value.split(','):
+        alternatives = tuple(
+            name.split('(')[0].split('=')[0].strip()
+            for name in item.split('|')
+        )
+        alternatives = tuple(name for name in alternatives if name)
+        if alternatives:
+            groups.append(alternatives)
+    return tuple(groups)
+
+
+def parse_packages_file(path):
+    """Yield one dict per stanza of an opkg Packages or Packages.gz file"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+        stanza = {}
+        field = None
+        for line in f:
+            line = line.rstrip('\n')
+            if not line:
+                if stanza:
+                    yield stanza
+                stanza, field = {}, None
+            elif line[0] in ' \t':
+                # Continuation of a multi-line field (Description)
+                if field:
+                    stanza[field] += '\n' + line.strip()
+            elif ':' in line:
+                field, value = line.split(':', 1)
+                stanza[field] = value.strip()
+        if stanza:
+            yield stanza
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _package_files(directory):
+    """Packages index of a feed directory, preferring the uncompressed file"""
+    for name in ('Packages', 'Packages.gz'):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return [path]
+    return []
+
+
+def _detect_arch(paths):
+    """Package architecture of a target, taken from its target feed"""
+    for path in paths:
+        for stanza in parse_packages_file(path):
+            arch = stanza.get('Architecture')
+            if arch and arch != 'all':
+                return arch
+    return None
+
+
+def find_sources(version, target, subtarget, roots=None):
+    """Return the Packages files for a version/target/subtarget, target feeds first"""
+    if roots is None:
+        roots = [os.path.join(MIRROR_DIR, 'releases', version), BUILD_BIN_DIR]
+
+    for root in roots:
+        target_dir = os.path.join(root, 'targets', target, subtarget)
+        target_files = _package_files(os.path.join(target_dir, 'packages'))
+        for kmods in sorted(glob.glob(os.path.join(target_dir, 'kmods', '*'))):
+            target_files += _package_files(kmods)
+        if not target_files:
+            continue
+
+        files = list(target_files)
+        arch = _detect_arch(target_files)
+        if arch:
+            for feed in sorted(glob.glob(os.path.join(root, 'packages', arch, '*'))):
+                files += _package_files(feed)
+        return files
+    return []
+
+
+def _signature(paths):
+    signature = []
+    for path in paths:
+        st = os.stat(path)
+        signature.append((path, st.st_ino, st.st_size, st.st_mtime_ns))
+    return tuple(signature)
+
+
+class PackageIndex:
+    """Sorted package names with their metadata, searchable by prefix or substring"""
+
+    def __init__(self, records, signature=()):
+        # records: {name: (version, size, installed_size, section, description,
+        #                  depends, provides, conflicts, feed)}
+        self.records = records
+        self.signature = signature
+        self.names = sorted(records)
+        self._search_text = [f"{name}\n{records[name][DESCRIPTION]}".lower() for name in self.names]
+        # Memoized package_resolver results for this index
+        self.resolutions = OrderedDict()
+        self.providers = {}
+        for name in self.names:
+            for provided in records[name][PROVIDES]:
+                for alias in provided:
+                    self.providers.setdefault(alias, []).append(name)
+
+    @classmethod
+    def from_files(cls, paths):
+        """Parse Packages files; earlier files win when a package appears twice"""
+        records = {}
+        for path in paths:
+            feed = os.path.basename(os.path.dirname(path))
+            for stanza in parse_packages_file(path):
+                name = stanza.get('Package')
+                if not name or name in records:
+                    continue
+                records[name] = (
+                    stanza.get('Version', ''),
+                    _to_int(stanza.get('Size')),
+                    _to_int(stanza.get('Installed-Size')),
+                    stanza.get('Section', ''),
+                    stanza.get('Description', '').split('\n', 1)[0],
+                    parse_relations(stanza.get('Depends', '')),
+                    parse_relations(stanza.get('Provides', '')),
+                    parse_relations(stanza.get('Conflicts', '')),
+                    feed,
+                )
+        return cls(records, _signature(paths))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.records
+
+    def get(self, name):
+        record = self.records.get(name)
+        if record is None:
+            return None
+        return {
+            'name': name,
+            'version': record[VERSION],
+            'size': record[SIZE],
+            'installed_size': record[INSTALLED_SIZE],
+            'section': record[SECTION],
+            'description': record[DESCRIPTION],
+            'feed': record[FEED],
+        }
+
+    def search(self, query='', mode='prefix', offset=0, limit=50):
+        """Return (total, [package dicts]) for names matching query"""
+        query = (query or '').lower()
+        if not query:
+            matches = self.names
+        elif mode == 'substring':
+            matches = [name for name, text in zip(self.names, self._search_text) if query in text]
+        else:
+            # Names are sorted, so prefix matches are one contiguous slice
+            start = bisect.bisect_left(self.names, query)
+            end = bisect.bisect_left(self.names, query + '\uffff', lo=start)
+            matches = self.names[start:end]
+        return len(matches), [self.get(name) for name in matches[offset:offset + limit]]
+
+    def save(self, path):
+        """Write the index to a pickle cache atomically"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((CACHE_FORMAT, self.signature, self.records), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, signature):
+        """Load a pickle cache, or return None if it is missing or stale"""
+        try:
+            with open(path, 'rb') as f:
+                cache_format, cached_signature, records = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return None
+        if cache_format != CACHE_FORMAT or cached_signature != signature:
+            return None
+        return cls(records, signature)
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_package_index(version, target, subtarget):
+    """Return the PackageIndex for a version/target/subtarget, or None if no feeds exist"""
+    key = (version, target, subtarget)
+    paths = find_sources(version, target, subtarget)
+    if not paths:
+        return None
+    signature = _signature(paths)
+
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is not None and index.signature == signature:
+            _indexes.move_to_end(key)
+            return index
+
+    cache_path = os.path.join(CACHE_DIR, f"{version}_{target}_{subtarget}.pickle")
+    index = PackageIndex.load(cache_path, signature)
+    if index is None:
+        logger.info(f"Building package index for {version} {target}/{subtarget} from {len(paths)} feeds")
+        index = PackageIndex.from_files(paths)
+        try:
+            index.save(cache_path)
+        except OSError as e:
+            logger.warning(f"Could not write package index cache {cache_path}: {e}")
+
+    with _indexes_lock:
+        _indexes[key] = index
+        _indexes.move_to_end(key)
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
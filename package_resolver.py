@@ -0,0 +1,154 @@
+"""
+Pre-flight dependency check for a package selection.
+
+Computes the transitive Depends closure of a package set from a
+PackageIndex, reports packages that cannot be found or resolved, conflicts
+inside the closure and excluded packages the selection still pulls in, and
+estimates the installed size. Results are memoized per index and package
+set, so re-checking the same selection on the config page is a dict lookup.
+"""
+
+import threading
+from collections import deque
+
+from package_index import CONFLICTS, DEPENDS, INSTALLED_SIZE, SIZE
+
+MAX_CACHED_RESOLUTIONS = 256
+
+
+class Resolution:
+    """Outcome of resolving a package set"""
+
+    def __init__(self, packages, missing, unresolved, conflicts, excluded_required,
+                 installed_size, download_size):
+        self.packages = packages
+        self.missing = missing
+        self.unresolved = unresolved
+        self.conflicts = conflicts
+        self.excluded_required = excluded_required
+        self.installed_size = installed_size
+        self.download_size = download_size
+
+    @property
+    def ok(self):
+        return not (self.missing or self.unresolved or self.conflicts or self.excluded_required)
+
+    def errors(self):
+        """Human readable list of problems"""
+        errors = [f"Package {name} not found" for name in self.missing]
+        errors += [f"{package} depends on {' | '.join(dependency)}, which is not available"
+                   for package, dependency in self.unresolved]
+        errors += [f"{a} conflicts with {b}" for a, b in self.conflicts]
+        errors += [f"{name} is excluded but required by the selection" for name in self.excluded_required]
+        return errors
+
+    def to_dict(self):
+        return {
+            'ok': self.ok,
+            'packages': self.packages,
+            'missing': self.missing,
+            'unresolved': [{'package': package, 'dependency': list(dependency)}
+                           for package, dependency in self.unresolved],
+            'conflicts': [list(pair) for pair in self.conflicts],
+            'excluded_required': self.excluded_required,
+            'installed_size': self.installed_size,
+            'download_size': self.download_size,
+            'errors': self.errors(),
+        }
+
+
+def _pick(index, alternatives, selected):
+    """Choose the package satisfying one dependency group, or None"""
+    # Prefer something already in the closure, real or provided
+    for name in alternatives:
+        if name in selected:
+            return name
+        for provider in index.providers.get(name, ()):
+            if provider in selected:
+                return provider
+    for name in alternatives:
+        if name in index:
+            return name
+        providers = index.providers.get(name)
+        if providers:
+            return providers[0]
+    return None
+
+
+def _resolve(index, requested, external, excluded):
+    selected = set()
+    missing = []
+    unresolved = []
+    queue = deque()
+
+    for name in requested:
+        if name in external:
+            continue
+        choice = _pick(index, (name,), selected)
+        if choice is None:
+            missing.append(name)
+        elif choice not in selected:
+            selected.add(choice)
+            queue.append(choice)
+
+    while queue:
+        package = queue.popleft()
+        for group in index.records[package][DEPENDS]:
+            if any(name in external for name in group):
+                continue
+            choice = _pick(index, group, selected)
+            if choice is None:
+                unresolved.append((package, group))
+            elif choice not in selected:
+                selected.add(choice)
+                queue.append(choice)
+
+    conflicts = set()
+    for package in selected:
+        for group in index.records[package][CONFLICTS]:
+            for name in group:
+                if name != package and name in selected:
+                    conflicts.add(tuple(sorted((package, name))))
+
+    requested_set = set(requested)
+    excluded_required = sorted(name for name in excluded
+                               if name in selected and name not in requested_set)
+
+    return Resolution(
+        packages=sorted(selected),
+        missing=sorted(set(missing)),
+        unresolved=sorted(set(unresolved)),
+        conflicts=sorted(conflicts),
+        excluded_required=excluded_required,
+        installed_size=sum(index.records[name][INSTALLED_SIZE] for name in selected),
+        download_size=sum(index.records[name][SIZE] for name in selected),
+    )
+
+
+_cache_lock = threading.Lock()
+
+
+def resolve(index, requested, external=(), excluded=()):
+    """Resolve requested packages against index
+
+    external names come from custom feeds that are not in the index and are
+    accepted as-is; excluded names must not be pulled in as dependencies.
+    """
+    key = (frozenset(requested), frozenset(external), frozenset(excluded))
+
+    # The cache lives on the index, so it is dropped together with an index
+    # whose feeds changed
+    with _cache_lock:
+        cache = index.resolutions
+        resolution = cache.get(key)
+        if resolution is not None:
+            cache.move_to_end(key)
+            return resolution
+
+    resolution = _resolve(index, list(dict.fromkeys(requested)), set(external), set(excluded))
+
+    with _cache_lock:
+        cache[key] = resolution
+        while len(cache) > MAX_CACHED_RESOLUTIONS:
+            cache.popitem(last=False)
+    return resolution
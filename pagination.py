@@ -0,0 +1,88 @@
+"""
+Keyset (cursor) pagination over (created_at, id), newest first.
+
+Unlike OFFSET pagination the cost of a page does not grow with its depth and
+no COUNT(*) is needed. Cursors are opaque url-safe strings encoding the sort
+key of the last (or first) row of a page.
+"""
+
+import base64
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(created_at, row_id):
+    raw = f"{created_at.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from e
+
+
+def clamp_limit(limit):
+    if not limit or limit < 1:
+        return DEFAULT_LIMIT
+    return min(limit, MAX_LIMIT)
+
+
+class KeysetPage:
+    """One page of rows plus the cursors to its neighbours"""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def keyset_paginate(query, model, after=None, before=None, limit=DEFAULT_LIMIT):
+    """Return the page of query rows after (older than) or before (newer than) a cursor"""
+    limit = clamp_limit(limit)
+    created_at, row_id = model.created_at, model.id
+
+    if before:
+        key_at, key_id = decode_cursor(before)
+        query = query.filter(or_(created_at > key_at, and_(created_at == key_at, row_id > key_id)))
+        query = query.order_by(created_at.asc(), row_id.asc())
+    else:
+        if after:
+            key_at, key_id = decode_cursor(after)
+            query = query.filter(or_(created_at < key_at, and_(created_at == key_at, row_id < key_id)))
+        query = query.order_by(created_at.desc(), row_id.desc())
+
+    # One extra row tells whether there is another page in this direction
+    rows = query.limit(limit + 1).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if before:
+        rows.reverse()
+
+    if not rows:
+        return KeysetPage([])
+
+    first = encode_cursor(rows[0].created_at, rows[0].id)
+    last = encode_cursor(rows[-1].created_at, rows[-1].id)
+    if before:
+        return KeysetPage(rows, next_cursor=last, prev_cursor=first if more else None)
+    return KeysetPage(rows, next_cursor=last if more else None, prev_cursor=first if after else None)
@@ -4,189 +4,746 @@ Build script for OpenWrt firmware and custom packages
 """
 
 import argparse
+import hashlib
+import json
 import logging
 import os
+import re
+import resource
 import shutil
+import signal
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
 from pathlib import Path
 
-import yaml
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import artifacts  # noqa: E402
+from build_log import BuildLog, LogShipper, format_summary  # noqa: E402
+from config_registry import ConfigRegistry  # noqa: E402
+from download_cache import DownloadCache, list_downloads  # noqa: E402
+from kconfig import PACKAGE_PREFIX, ConfigConflict, Kconfig  # noqa: E402
 
 logging.basicConfig(level=logging.INFO,
                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('build')
 
+OPENWRT_GIT_URL = 'https://git.openwrt.org/openwrt/openwrt.git'
+
+# Fewer make jobs than this per build is not worth running builds side by side
+MIN_JOBS_PER_BUILD = 4
+
+# Concurrent downloads of the download stage (default for build.download_jobs)
+DOWNLOAD_JOBS = 4
+
+# Build stages in order; output is cheap and always runs
+STAGES = ('source', 'feeds', 'config', 'download', 'toolchain', 'build', 'output')
+UNSTAMPED_STAGES = ('output',)
+STAMP_DIR = '.build-stamps'
+
+# Feeds updated at the same time
+FEED_UPDATE_JOBS = 4
+
+# Up to this many newly selected packages are compiled one by one instead
+# of running a full build
+TARGETED_BUILD_MAX_PACKAGES = 10
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Build OpenWrt firmware and packages')
-    parser.add_argument('--target', required=True, help='OpenWrt target (e.g., x86)')
-    parser.add_argument('--subtarget', required=True, help='OpenWrt subtarget (e.g., 64)')
+    parser.add_argument('--target', help='OpenWrt target (e.g., x86)')
+    parser.add_argument('--subtarget', help='OpenWrt subtarget (e.g., 64)')
+    parser.add_argument('--all-targets', action='store_true', help='Build every target in openwrt.yml')
+    parser.add_argument('--targets', help='Comma separated targets to build, as target or target/subtarget')
     parser.add_argument('--openwrt-version', required=True, help='OpenWrt version to build')
     parser.add_argument('--version', required=True, help='Release version')
     parser.add_argument('--config-dir', default='./config', help='Configuration directory')
+    parser.add_argument('--repositories', help='JSON file with additional feed repositories (from the web app)')
+    parser.add_argument('--jobs', type=int, help='Parallel make jobs (default: build.jobs from config, or CPU count)')
+    parser.add_argument('--download-cache',
+                        help='Host-wide download store shared by all builds '
+                             '(default: $OPENWRT_DOWNLOAD_CACHE or build.download_cache from config)')
+    parser.add_argument('--parallel', type=int,
+                        help='Targets built at once with --all-targets/--targets (default: from the job budget)')
+    parser.add_argument('--worktree-dir', default='worktrees',
+                        help='Shared OpenWrt object store and per-target worktrees for multi-target builds')
+    parser.add_argument('--source-ready', action='store_true',
+                        help='openwrt/ is already checked out at the right version, do not fetch')
+    parser.add_argument('--force-stage', action='append', default=[], choices=STAGES + ('all',),
+                        help='Run a stage and the stages after it even if their inputs did not change; repeatable')
+    parser.add_argument('--stage-log', help='Append a JSON timing record for every stage to this file')
+    parser.add_argument('--webhook-url', default=os.environ.get('WEBHOOK_URL'),
+                        help='Web app webhook to stream build output to (default: $WEBHOOK_URL)')
+    parser.add_argument('--build-id', default=os.environ.get('BUILD_ID'),
+                        help='Build the streamed output belongs to (default: $BUILD_ID)')
     parser.add_argument('--debug', action='store_true', help='Enable debug output')
-    return parser.parse_args()
+    args = parser.parse_args()
+    
+    if not (args.all_targets or args.targets) and not (args.target and args.subtarget):
+        parser.error('--target and --subtarget are required unless --all-targets or --targets is given')
+    return args
 
 def load_config(config_dir):
     """Load configuration files"""
-    openwrt_config_file = os.path.join(config_dir, 'openwrt.yml')
-    packages_config_file = os.path.join(config_dir, 'packages.yml')
+    return ConfigRegistry(config_dir, strict=True)
+
+def download_cache_dir(args, registry):
+    """Directory of the shared download store, or None to download into dl/ only"""
+    path = (args.download_cache or os.environ.get('OPENWRT_DOWNLOAD_CACHE')
+            or registry.openwrt_config().get('build', {}).get('download_cache'))
+    return os.path.abspath(os.path.expanduser(path)) if path else None
+
+def ccache_settings(openwrt_config):
+    """{'dir', 'max_size'} of build.ccache in openwrt.yml, or None if ccache is off"""
+    settings = openwrt_config.get('build', {}).get('ccache') or {}
+    if not settings.get('enabled'):
+        return None
+    return {
+        'dir': os.path.abspath(os.path.expanduser(settings.get('dir') or '~/.cache/openwrt-ccache')),
+        'max_size': str(settings.get('max_size') or '20G'),
+    }
+
+def wait_with_usage(process):
+    """Wait for a Popen process, returns (returncode, resource usage of it and its children)"""
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        return process.wait(), None
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    return process.returncode, usage
+
+def command_peak_rss(usage):
+    """Peak RSS (KiB) of a finished command, or None if it cannot be told apart from ours
+    
+    A forked child starts with this script's RSS and Linux carries that
+    high-water mark over exec, so ru_maxrss is never below it. Only a peak
+    above this script's own one is the command's.
+    """
+    if usage is None or usage.ru_maxrss <= resource.getrusage(resource.RUSAGE_SELF).ru_maxrss:
+        return None
+    return usage.ru_maxrss
+
+def load_repositories(path):
+    """Feed repositories exported by the web app (enabled Repository rows)"""
+    if not path:
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+def feed_name(name):
+    """Repository name usable as an OpenWrt feed name"""
+    return re.sub(r'[^A-Za-z0-9_]', '_', name)
+
+def merge_repositories(packages_config, extra=()):
+    """Custom feeds of a build: packages.yml in file order, then extra ones by name
     
-    with open(openwrt_config_file, 'r') as f:
-        openwrt_config = yaml.safe_load(f)
+    Disabled repositories are left out; when two share a feed name the first
+    definition is used.
+    """
+    repositories = []
+    seen = set()
+    for repo in list(packages_config.get('repositories', [])) + sorted(extra, key=lambda r: r['name']):
+        if repo.get('enabled', True) is False:
+            continue
+        name = feed_name(repo['name'])
+        if name in seen:
+            logger.warning(f"Feed {name} is defined more than once, using the first definition")
+            continue
+        seen.add(name)
+        repositories.append({**repo, 'name': name, 'branch': repo.get('branch') or 'main'})
+    return repositories
+
+class BuildContext:
+    """Settings and paths of one target build, shared by all build stages
     
-    with open(packages_config_file, 'r') as f:
-        packages_config = yaml.safe_load(f)
+    Stages never change the working directory: every command runs with an
+    explicit cwd, so stages (and builds) can run in threads side by side.
+    Child processes are tracked so they can be stopped when a stage fails.
+    """
     
-    return openwrt_config, packages_config
+    def __init__(self, registry, target, subtarget, openwrt_version, version,
+                 work_dir='.', jobs=None, source_ready=False, repositories=(), download_cache=None,
+                 stage_log=None):
+        self.registry = registry
+        self.target = target
+        self.subtarget = subtarget
+        self.openwrt_version = openwrt_version
+        self.version = version
+        self.work_dir = os.path.abspath(work_dir)
+        self.source_dir = os.path.join(self.work_dir, 'openwrt')
+        self.output_root = os.path.join(self.work_dir, 'output')
+        self.jobs = jobs or self.openwrt_config.get('build', {}).get('jobs', os.cpu_count())
+        self.source_ready = source_ready
+        self.repositories = merge_repositories(self.packages_config, repositories)
+        self.download_cache = DownloadCache(download_cache) if download_cache else None
+        self.ccache = ccache_settings(self.openwrt_config)
+        # Figures reported with the build result, e.g. download cache hits
+        self.stats = {}
+        self.stage_log = stage_log
+        # BuildLog all command output goes through while the pipeline runs
+        self.log = None
+        self.stage = None
+        self._usage = None
+        self._feed_heads = {}
+        self._processes = set()
+        self._lock = threading.Lock()
+        self._stopping = False
+    
+    @property
+    def openwrt_config(self):
+        return self.registry.openwrt_config()
+    
+    @property
+    def packages_config(self):
+        return self.registry.packages_config()
+    
+    def path(self, *parts):
+        """Path inside the OpenWrt source tree"""
+        return os.path.join(self.source_dir, *parts)
+    
+    def run(self, cmd, cwd=None, env=None):
+        """Run a command in the source tree (or cwd), raising CalledProcessError on failure"""
+        cwd = cwd or self.source_dir
+        logger.debug(f"Running {' '.join(cmd)} in {cwd}")
+        with self._lock:
+            if self._stopping:
+                raise RuntimeError(f"Build stopped, not running {' '.join(cmd)}")
+            # A session of its own, so stop() can end make with everything it started
+            process = subprocess.Popen(cmd, cwd=cwd, env=env, start_new_session=True,
+                                       stdout=subprocess.PIPE if self.log else None,
+                                       stderr=subprocess.STDOUT if self.log else None)
+            self._processes.add(process)
+        usage = None
+        try:
+            if self.log:
+                with process.stdout:
+                    self.log.consume(process.stdout)
+            returncode, usage = wait_with_usage(process)
+        finally:
+            if process.returncode is None:
+                # Interrupted, e.g. by ^C: do not leave the command running
+                self._terminate(process)
+            with self._lock:
+                self._processes.discard(process)
+                if usage is not None and self._usage is not None:
+                    self._usage['cpu_time'] += usage.ru_utime + usage.ru_stime
+                    self._usage['peak_rss'] = max(self._usage['peak_rss'], command_peak_rss(usage) or 0)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+    
+    def capture(self, cmd, cwd=None, timeout=60, env=None):
+        """Output of a quick query command, or None if it fails"""
+        try:
+            result = subprocess.run(cmd, cwd=cwd or self.source_dir, capture_output=True, text=True,
+                                    timeout=timeout, check=True,
+                                    env={**(env or os.environ), 'GIT_TERMINAL_PROMPT': '0'})
+        except (OSError, subprocess.SubprocessError):
+            return None
+        return result.stdout.strip()
+    
+    def read_stamp(self, stage):
+        try:
+            with open(self.path(STAMP_DIR, f'{stage}.json')) as f:
+                return json.load(f).get('key')
+        except (OSError, ValueError):
+            return None
+    
+    def write_stamp(self, stage, key):
+        """Record that a stage completed for the given input key"""
+        path = self.path(STAMP_DIR, f'{stage}.json')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': key, 'finished_at': time.strftime('%Y-%m-%d %H:%M:%S')}, f)
+        os.replace(tmp_path, path)
+    
+    def clear_stamp(self, stage):
+        try:
+            os.remove(self.path(STAMP_DIR, f'{stage}.json'))
+        except FileNotFoundError:
+            pass
+    
+    @property
+    def stopping(self):
+        return self._stopping
+    
+    def stop(self):
+        """Terminate all running commands of this build"""
+        with self._lock:
+            self._stopping = True
+            processes = list(self._processes)
+        for process in processes:
+            self._signal(process, signal.SIGTERM)
+        # The threads running the commands reap them (and take their resource usage)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self._processes.intersection(processes):
+                    return
+            time.sleep(0.1)
+        for process in processes:
+            if process.returncode is None:
+                self._signal(process, signal.SIGKILL)
+    
+    @staticmethod
+    def _signal(process, signum):
+        try:
+            os.killpg(process.pid, signum)
+        except ProcessLookupError:
+            pass
+    
+    def _terminate(self, process):
+        self._signal(process, signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self._signal(process, signal.SIGKILL)
+            process.wait()
+    
+    def record_stage(self, name, status, started_at=None, wall_time=None, cpu_time=None, peak_rss=None):
+        """Add a stage timing record to the build stats and the stage log
+        
+        peak_rss is None when no command of the stage grew beyond the RSS of
+        this script, which its children inherit (see command_peak_rss).
+        """
+        record = {
+            'stage': name,
+            'position': STAGES.index(name),
+            'status': status,
+            'started_at': started_at.isoformat() if started_at else None,
+            'wall_time': round(wall_time, 2) if wall_time is not None else None,
+            'cpu_time': round(cpu_time, 2) if cpu_time is not None else None,
+            'peak_rss': peak_rss,
+        }
+        self.stats.setdefault('stages', []).append(record)
+        if self.stage_log:
+            with open(self.stage_log, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        if self.log and self.log.shipper:
+            # Builds outside the local worker report their timings to the web app themselves
+            self.log.shipper.add_event({'event_type': 'build_stage', **record})
+    
+    @contextmanager
+    def stage_timer(self, name):
+        """Time a stage: wall time, CPU time and peak RSS (KiB) of the commands it runs"""
+        self.stage = name
+        logger.info(f"Stage {name} started")
+        if self.log:
+            self.log.note(f"==> Stage {name}", echo=False)
+        started_at = datetime.utcnow()
+        start_time = time.monotonic()
+        with self._lock:
+            self._usage = {'cpu_time': 0.0, 'peak_rss': 0}
+        status = 'failed'
+        try:
+            yield
+            status = 'success'
+        finally:
+            wall_time = time.monotonic() - start_time
+            with self._lock:
+                usage, self._usage = self._usage, None
+            self.record_stage(name, status, started_at, wall_time, usage['cpu_time'], usage['peak_rss'] or None)
+            peak_rss = f"{usage['peak_rss'] / 1024:.0f} MiB" if usage['peak_rss'] else 'n/a'
+            logger.info(f"Stage {name} {'finished' if status == 'success' else 'failed'} in {wall_time:.1f} seconds "
+                        f"(CPU {usage['cpu_time']:.1f} seconds, peak RSS {peak_rss})")
 
-def setup_openwrt_source(version):
+def setup_openwrt_source(ctx):
     """Setup OpenWrt source code"""
-    if not os.path.exists('openwrt'):
+    version = ctx.openwrt_version
+    if ctx.source_ready:
+        logger.info(f"Using prepared OpenWrt v{version} source")
+    elif not os.path.exists(ctx.source_dir):
         logger.info(f"Cloning OpenWrt v{version}...")
-        subprocess.run([
-            'git', 'clone', 'https://git.openwrt.org/openwrt/openwrt.git'
-        ], check=True)
-        
-        os.chdir('openwrt')
-        subprocess.run([
-            'git', 'checkout', f'v{version}'
-        ], check=True)
+        ctx.run(['git', 'clone', OPENWRT_GIT_URL, ctx.source_dir], cwd=ctx.work_dir)
+        ctx.run(['git', 'checkout', f'v{version}'])
     else:
         logger.info(f"Using existing OpenWrt source, checking out v{version}...")
-        os.chdir('openwrt')
-        subprocess.run(['git', 'fetch', '--all'], check=True)
-        subprocess.run(['git', 'checkout', f'v{version}'], check=True)
+        ctx.run(['git', 'fetch', '--all'])
+        # Older versions of this script appended custom feeds to it
+        ctx.run(['git', 'checkout', '--', 'feeds.conf.default'])
+        ctx.run(['git', 'checkout', f'v{version}'])
+
+def default_feeds_conf(ctx):
+    """feeds.conf.default as committed in the checked out release
+    
+    The working tree copy is not trusted: older versions of this script
+    appended custom feeds to it, and a skipped source stage keeps it as is.
+    """
+    committed = ctx.capture(['git', 'show', 'HEAD:feeds.conf.default'])
+    if committed is not None:
+        return committed
+    with open(ctx.path('feeds.conf.default')) as f:
+        return f.read()
+
+def generate_feeds_conf(ctx):
+    """feeds.conf contents: the default feeds of the release, then the custom feeds
     
-    # Update feeds
-    subprocess.run(['./scripts/feeds', 'update', '-a'], check=True)
-    subprocess.run(['./scripts/feeds', 'install', '-a'], check=True)
+    A custom repository replaces a default feed of the same name.
+    """
+    custom = {repo['name'] for repo in ctx.repositories}
+    lines = []
+    for line in default_feeds_conf(ctx).splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split()
+        if len(parts) >= 2 and parts[1] in custom:
+            logger.info(f"Custom repository {parts[1]} replaces the default feed of that name")
+            continue
+        lines.append(line)
+    for repo in ctx.repositories:
+        lines.append(f"src-git {repo['name']} {repo['url']};{repo['branch']}")
+    return '\n'.join(lines) + '\n'
+
+def parse_feeds(feeds_conf):
+    """[(name, source)] of the feed lines of a feeds.conf"""
+    feeds = []
+    for line in feeds_conf.splitlines():
+        parts = line.split()
+        if len(parts) >= 3 and parts[0].startswith('src-'):
+            feeds.append((parts[1], f"{parts[0]} {parts[2]}"))
+    return feeds
+
+def feed_heads(ctx, feeds):
+    """Current commit of each feed: pinned (^commit) or its branch head, None if unknown"""
+    def head(source):
+        kind, location = source.split(' ', 1)
+        if not kind.startswith('src-git'):
+            return location
+        if '^' in location:
+            return location.split('^', 1)[1]
+        if source not in ctx._feed_heads:
+            url, _, branch = location.partition(';')
+            output = ctx.capture(['git', 'ls-remote', url, branch or 'HEAD'], cwd=ctx.work_dir)
+            ctx._feed_heads[source] = output.split()[0] if output else None
+        return ctx._feed_heads[source]
     
-    os.chdir('..')
+    if not feeds:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(8, len(feeds))) as pool:
+        return dict(zip([name for name, _ in feeds], pool.map(head, [source for _, source in feeds])))
 
-def add_custom_package_feeds(packages_config):
-    """Add custom package feeds"""
-    os.chdir('openwrt')
+def update_feeds(ctx):
+    """Write feeds.conf and update the feeds whose source or head changed"""
+    feeds_conf = generate_feeds_conf(ctx)
+    path = ctx.path('feeds.conf')
+    try:
+        with open(path) as f:
+            current = f.read()
+    except FileNotFoundError:
+        current = None
+    if current != feeds_conf:
+        logger.info(f"Writing {path}")
+        with open(f"{path}.tmp", 'w') as f:
+            f.write(feeds_conf)
+        os.replace(f"{path}.tmp", path)
+    
+    # What every feed was last updated to
+    manifest_path = ctx.path(STAMP_DIR, 'feeds-manifest.json')
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
     
-    # Add custom package repositories to feeds.conf
-    with open('feeds.conf.default', 'a') as f:
-        for repo in packages_config.get('repositories', []):
-            feed_line = f"src-git {repo['name']} {repo['url']};{repo['branch']}\n"
-            logger.info(f"Adding feed: {feed_line.strip()}")
-            f.write(feed_line)
+    feeds = parse_feeds(feeds_conf)
+    heads = feed_heads(ctx, feeds)
+    changed = [name for name, source in feeds
+               if heads[name] is None
+               or manifest.get(name) != {'source': source, 'head': heads[name]}
+               or not os.path.isdir(ctx.path('feeds', name))]
+    removed = set(manifest) - set(heads)
+    logger.info(f"{len(changed)} of {len(feeds)} feeds changed" + (f": {', '.join(changed)}" if changed else ''))
     
-    # Update and install all feeds
-    subprocess.run(['./scripts/feeds', 'update', '-a'], check=True)
-    subprocess.run(['./scripts/feeds', 'install', '-a'], check=True)
+    lock = threading.Lock()
     
-    os.chdir('..')
+    def update(name):
+        ctx.run(['./scripts/feeds', 'update', name])
+        with lock:
+            manifest[name] = {'source': dict(feeds)[name], 'head': heads[name]}
+    
+    try:
+        if changed:
+            with ThreadPoolExecutor(max_workers=min(FEED_UPDATE_JOBS, len(changed))) as pool:
+                futures = [pool.submit(update, name) for name in changed]
+                for future in futures:
+                    future.result()
+    finally:
+        # Feeds that did update are not fetched again after a failure
+        for name in removed:
+            manifest.pop(name, None)
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        with open(f"{manifest_path}.tmp", 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
+    
+    # Package symlinks of a dropped feed would shadow the remaining feeds
+    if removed:
+        logger.info(f"Removing feeds: {', '.join(sorted(removed))}")
+        ctx.run(['./scripts/feeds', 'uninstall', '-a'])
+    if changed or removed or current != feeds_conf:
+        ctx.run(['./scripts/feeds', 'install', '-a'])
+
+def config_model(ctx):
+    """Kconfig with every symbol the build configuration asks for"""
+    registry = ctx.registry
+    target, subtarget = ctx.target, ctx.subtarget
+    build_config = ctx.openwrt_config.get('build', {})
+    
+    config = Kconfig()
+    config.set(f'CONFIG_TARGET_{target}', 'y', 'target')
+    config.set(f'CONFIG_TARGET_{target}_{subtarget}', 'y', 'target')
+    if ctx.ccache:
+        config.set('CONFIG_DEVEL', 'y', 'build_options')
+        config.set('CONFIG_CCACHE', 'y', 'build_options')
+        config.set('CONFIG_CCACHE_DIR', f'"{ctx.ccache["dir"]}"', 'build_options')
+    for option in build_config.get('kernel_config', []):
+        config.set_line(option, 'kernel_config')
+    for package in build_config.get('base_packages', []):
+        config.select_package(package, 'base_packages')
+    for package in registry.include_packages(target, subtarget):
+        config.select_package(package, 'include_packages')
+    for repo in ctx.repositories:
+        for package in repo.get('packages') or []:
+            config.select_package(package, 'repository_packages')
+    for package in registry.exclude_packages(target, subtarget):
+        config.deselect_package(package, 'exclude_packages')
+    config.set('CONFIG_VERSION_NUMBER', f'"{ctx.version}"', 'version')
+    config.set('CONFIG_VERSION_CODE', f'"{ctx.version}"', 'version')
+    return config
 
-def create_config(openwrt_config, packages_config, target, subtarget, version):
+def create_config(ctx):
     """Create OpenWrt config file (.config)"""
-    os.chdir('openwrt')
-    
-    # Generate default config for target
-    logger.info(f"Creating config for {target}/{subtarget}...")
-    subprocess.run([
-        'make', 'defconfig', 
-        f'TARGET={target}', 
-        f'SUBTARGET={subtarget}'
-    ], check=True)
-    
-    # Add custom kernel options
-    logger.info("Adding kernel configuration options...")
-    with open('.config', 'a') as f:
-        for option in openwrt_config.get('build', {}).get('kernel_config', []):
-            f.write(f"{option}\n")
-    
-    # Add base packages for all targets
-    with open('.config', 'a') as f:
-        for package in openwrt_config.get('build', {}).get('base_packages', []):
-            f.write(f"CONFIG_PACKAGE_{package}=y\n")
-    
-    # Add target-specific packages
-    with open('.config', 'a') as f:
-        # Add packages for all targets
-        for package in packages_config.get('include_packages', {}).get('all', []):
-            f.write(f"CONFIG_PACKAGE_{package}=y\n")
-            
-        # Add packages for specific target+subtarget
-        target_key = f"{target}_{subtarget}"
-        for package in packages_config.get('include_packages', {}).get(target_key, []):
-            f.write(f"CONFIG_PACKAGE_{package}=y\n")
-    
-    # Add custom repository packages
-    with open('.config', 'a') as f:
-        for repo in packages_config.get('repositories', []):
-            for package in repo.get('packages', []):
-                f.write(f"CONFIG_PACKAGE_{package}=y\n")
-    
-    # Exclude packages
-    with open('.config', 'a') as f:
-        # Exclude packages for all targets
-        for package in packages_config.get('exclude_packages', {}).get('all', []):
-            f.write(f"# CONFIG_PACKAGE_{package} is not set\n")
-            
-        # Exclude packages for specific target+subtarget
-        target_key = f"{target}_{subtarget}"
-        for package in packages_config.get('exclude_packages', {}).get(target_key, []):
-            f.write(f"# CONFIG_PACKAGE_{package} is not set\n")
-    
-    # Set version in the config
-    with open('.config', 'a') as f:
-        f.write(f'CONFIG_VERSION_NUMBER="{version}"\n')
-        f.write(f'CONFIG_VERSION_CODE="{version}"\n')
-    
-    # Run make defconfig to normalize the config file
-    subprocess.run(['make', 'defconfig'], check=True)
-    
-    os.chdir('..')
-
-def build_firmware(openwrt_config, target, subtarget):
-    """Build the OpenWrt firmware"""
-    os.chdir('openwrt')
+    logger.info(f"Creating config for {ctx.target}/{ctx.subtarget}...")
+    config = config_model(ctx)
+    for symbol, source, value, winner, winning_value in config.overrides:
+        logger.warning(f"{symbol}: {winner} ({winning_value or 'not set'}) overrides "
+                       f"{source} ({value or 'not set'})")
+    for symbol, first, repeated in config.duplicates:
+        logger.debug(f"{symbol} is set by both {first} and {repeated}")
     
-    # Get number of parallel jobs from config or default to CPU count
-    jobs = openwrt_config.get('build', {}).get('jobs', os.cpu_count())
+    # The seed and the feeds it was normalized against decide the result of
+    # defconfig; if neither changed and .config is untouched, reuse it
+    config_path = ctx.path('.config')
+    state_path = ctx.path(STAMP_DIR, 'config-state.json')
+    seed_digest = _digest(config.render(), ctx.read_stamp('source'), ctx.read_stamp('feeds'))
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    if state.get('seed') == seed_digest and state.get('config') == _file_digest(config_path):
+        logger.info("Configuration unchanged, skipping defconfig")
+        return
     
-    # Start the build process
-    logger.info(f"Building OpenWrt firmware for {target}/{subtarget} with {jobs} jobs...")
-    start_time = time.time()
+    config.write(config_path)
     
-    # Create downloads directory if it doesn't exist
-    if not os.path.exists('dl'):
-        os.makedirs('dl')
+    # Run make defconfig to expand dependencies and normalize the config file
+    ctx.run(['make', 'defconfig'])
     
-    # Run the build
-    build_cmd = [
-        'make', 
-        '-j', str(jobs),
-        'V=s'  # Verbose output
-    ]
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    with open(state_path, 'w') as f:
+        json.dump({'seed': seed_digest, 'config': _file_digest(config_path)}, f)
+
+def download_sources(ctx):
+    """Fetch the sources of the toolchain and all selected packages before compiling
+    
+    With a download cache, download.pl looks in the store before the
+    network, and afterwards dl/ is stored and hardlinked to the store.
+    """
+    dl_dir = ctx.path('dl')
+    os.makedirs(dl_dir, exist_ok=True)
+    # Network bound, so the job count does not come from the CPU budget
+    jobs = ctx.openwrt_config.get('build', {}).get('download_jobs', DOWNLOAD_JOBS)
+    cmd = ['make', 'download', '-j', str(jobs)]
     
+    cache = ctx.download_cache
+    if cache is None:
+        ctx.run(cmd)
+        return
+    
+    before, known = list_downloads(dl_dir), cache.names()
+    mirrors = [cache.mirror] + [m for m in os.environ.get('DOWNLOAD_MIRROR', '').split(';') if m]
     try:
-        subprocess.run(build_cmd, check=True)
-        logger.info(f"Build completed successfully in {time.time() - start_time:.1f} seconds")
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Build failed: {e}")
-        sys.exit(1)
+        ctx.run(cmd, env={**os.environ, 'DOWNLOAD_MIRROR': ';'.join(mirrors)})
+    finally:
+        # Whatever was fetched before a failure is kept for the next build
+        stats = cache.collect(dl_dir, before, known)
+        ctx.stats['download_cache'] = stats
+        rate = f"{stats['hit_rate']:.0%}" if stats['hit_rate'] is not None else 'n/a'
+        logger.info(f"Download cache: {stats['hits']} hits ({stats['hit_bytes'] / 1024 ** 2:.1f} MiB), "
+                    f"{stats['misses']} misses ({stats['miss_bytes'] / 1024 ** 2:.1f} MiB), hit rate {rate}")
+
+def ccache_env(ctx):
+    # The environment overrides ccache.conf, so the cap holds for every build
+    return {**os.environ, 'CCACHE_DIR': ctx.ccache['dir'], 'CCACHE_MAXSIZE': ctx.ccache['max_size']}
+
+def read_ccache_stats(ctx):
+    """(hits, misses) counters of the cache directory, or None if ccache cannot be queried"""
+    # The ccache OpenWrt built for itself, or the host's before the tools are built
+    binary = ctx.path('staging_dir', 'host', 'bin', 'ccache')
+    if not os.access(binary, os.X_OK):
+        binary = shutil.which('ccache')
+    if not binary:
+        return None
+    output = ctx.capture([binary, '--print-stats'], env=ccache_env(ctx))
+    if output is None:
+        return None
+    counters = {}
+    for line in output.splitlines():
+        key, _, value = line.partition('\t')
+        if value.strip().isdigit():
+            counters[key] = int(value)
+    return (counters.get('direct_cache_hit', 0) + counters.get('preprocessed_cache_hit', 0),
+            counters.get('cache_miss', 0))
+
+def record_ccache_stats(ctx, before, after, duration):
+    """Add the cache activity of one make run to the build stats and log it
+    
+    The counters belong to the shared directory, so builds running at the
+    same time on the same cache are counted together.
+    """
+    if before is None or after is None:
+        logger.info("ccache statistics are not available for this run")
+        return
+    hits, misses = after[0] - before[0], after[1] - before[1]
+    # A hit is assumed to save what an average miss costs; only an estimate,
+    # since the run time includes more than compiling
+    saved = hits * duration / misses if misses else None
+    lookups = hits + misses
+    logger.info(f"ccache: {hits} hits, {misses} misses"
+                + (f", hit rate {hits / lookups:.0%}" if lookups else '')
+                + (f", about {saved:.0f} seconds saved" if saved is not None else ''))
+    
+    stats = ctx.stats.setdefault('ccache', {
+        'dir': ctx.ccache['dir'], 'max_size': ctx.ccache['max_size'],
+        'hits': 0, 'misses': 0, 'compile_time': 0.0, 'estimated_time_saved': None,
+    })
+    stats['hits'] += hits
+    stats['misses'] += misses
+    stats['compile_time'] = round(stats['compile_time'] + duration, 1)
+    if saved is not None:
+        stats['estimated_time_saved'] = round((stats['estimated_time_saved'] or 0) + saved, 1)
+    total = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / total, 3) if total else None
+
+def run_make(ctx, cmd):
+    """Run a make that compiles, through ccache when it is enabled"""
+    if ctx.ccache is None:
+        ctx.run(cmd)
+        return
+    os.makedirs(ctx.ccache['dir'], exist_ok=True)
+    before = read_ccache_stats(ctx)
+    start_time = time.time()
+    try:
+        ctx.run(cmd, env=ccache_env(ctx))
+    finally:
+        record_ccache_stats(ctx, before, read_ccache_stats(ctx), time.time() - start_time)
+
+def build_toolchain(ctx):
+    """Build the host tools and the cross toolchain"""
+    run_make(ctx, ['make', 'tools/install', 'toolchain/install', '-j', str(ctx.jobs)])
+
+def _build_base(ctx, config):
+    """What a targeted build must share with the last full build"""
+    return _digest(config.without_packages().render(), ctx.read_stamp('source'), ctx.read_stamp('feeds'))
+
+def packages_to_compile(ctx):
+    """Packages newly selected since the last successful build, or None if a full build is needed
+    
+    Only when nothing but package selections changed, the feeds and source
+    are the same and at most TARGETED_BUILD_MAX_PACKAGES were added.
+    """
+    built = Kconfig.load(ctx.path(STAMP_DIR, 'built.config'))
+    current = Kconfig.load(ctx.path('.config'))
+    if built is None or current is None:
+        return None
+    try:
+        with open(ctx.path(STAMP_DIR, 'built.json')) as f:
+            base = json.load(f).get('base')
+    except (OSError, ValueError):
+        return None
+    if base != _build_base(ctx, current):
+        return None
     
-    os.chdir('..')
+    changes = current.diff(built)
+    if not changes or any(not symbol.startswith(PACKAGE_PREFIX) for symbol in changes):
+        return None
+    added = sorted(symbol[len(PACKAGE_PREFIX):] for symbol, (_, new) in changes.items() if new == 'y')
+    if len(added) > TARGETED_BUILD_MAX_PACKAGES:
+        return None
+    return added
+
+def build_packages(ctx, packages):
+    """Compile a few packages and rebuild the images from the existing build"""
+    logger.info(f"Only package selections changed, compiling {', '.join(packages) or 'no packages'}")
+    for package in packages:
+        run_make(ctx, ['make', f'package/{package}/compile', '-j', str(ctx.jobs), 'V=s'])
+    ctx.run(['make', 'package/install', 'target/install', 'package/index', 'checksum', 'V=s'])
+
+def record_build(ctx):
+    """Remember the config of a successful build for later targeted builds"""
+    config = Kconfig.load(ctx.path('.config'))
+    os.makedirs(ctx.path(STAMP_DIR), exist_ok=True)
+    shutil.copyfile(ctx.path('.config'), ctx.path(STAMP_DIR, 'built.config'))
+    with open(ctx.path(STAMP_DIR, 'built.json'), 'w') as f:
+        json.dump({'base': _build_base(ctx, config)}, f)
 
-def create_output_directory(target, subtarget, version):
+def build_firmware(ctx):
+    """Build the OpenWrt firmware"""
+    # Start the build process
+    logger.info(f"Building OpenWrt firmware for {ctx.target}/{ctx.subtarget} with {ctx.jobs} jobs...")
+    start_time = time.time()
+    
+    # Images of the last build may be hardlinked into an output directory;
+    # make must write new files rather than overwrite those in place
+    artifacts.detach(ctx.path('bin', 'targets', ctx.target, ctx.subtarget))
+    
+    packages = packages_to_compile(ctx)
+    built = False
+    if packages is not None:
+        try:
+            build_packages(ctx, packages)
+            built = True
+        except subprocess.CalledProcessError as e:
+            if ctx.stopping:
+                raise
+            logger.warning(f"Targeted build failed ({e}), running a full build")
+    
+    if not built:
+        # Run the build
+        build_cmd = [
+            'make', 
+            '-j', str(ctx.jobs),
+            'V=s'  # Verbose output
+        ]
+        run_make(ctx, build_cmd)
+    record_build(ctx)
+    logger.info(f"Build completed successfully in {time.time() - start_time:.1f} seconds")
+
+def create_output_directory(ctx):
     """Create and organize the output directory"""
-    output_dir = f"output/{target}_{subtarget}_{version}"
+    target, subtarget, version = ctx.target, ctx.subtarget, ctx.version
+    output_dir = os.path.join(ctx.output_root, f"{target}_{subtarget}_{version}")
     os.makedirs(output_dir, exist_ok=True)
     
-    # Copy firmware files
-    firmware_path = f"openwrt/bin/targets/{target}/{subtarget}"
-    for file in os.listdir(firmware_path):
-        if file.endswith(('.bin', '.buildinfo', '.manifest')) or file == 'sha256sums':
-            shutil.copy(
-                os.path.join(firmware_path, file),
-                os.path.join(output_dir, file)
-            )
+    # Link (or copy) firmware files and list them in artifacts.json
+    settings = ctx.openwrt_config.get('build', {}).get('artifacts') or {}
+    manifest = artifacts.collect(
+        ctx.path('bin', 'targets', target, subtarget), output_dir,
+        include=settings.get('include') or artifacts.DEFAULT_INCLUDE,
+        exclude=settings.get('exclude') or artifacts.DEFAULT_EXCLUDE,
+        metadata={'target': target, 'subtarget': subtarget, 'version': version,
+                  'openwrt_version': ctx.openwrt_version},
+    )
+    ctx.stats['artifacts'] = len(manifest['artifacts'])
+    
+    # Numbers of this run for the build summary
+    with open(os.path.join(output_dir, 'build-stats.json'), 'w') as f:
+        json.dump(ctx.stats, f, indent=2)
     
     # Create a version file
     with open(os.path.join(output_dir, 'version.txt'), 'w') as f:
@@ -199,28 +756,403 @@ def create_output_directory(target, subtarget, version):
     logger.info(f"Output saved to {output_dir}")
     return output_dir
 
+STAGE_FUNCTIONS = {
+    'source': setup_openwrt_source,
+    'feeds': update_feeds,
+    'config': create_config,
+    'download': download_sources,
+    'toolchain': build_toolchain,
+    'build': build_firmware,
+    'output': create_output_directory,
+}
+
+def _digest(*values):
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+def _file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def stage_key(ctx, stage):
+    """Hash of everything a stage's result depends on, None if it cannot be known yet
+    
+    Keys include the stamps of the stages whose results they consume, so
+    they are only final once those stages are done.
+    """
+    if stage == 'source':
+        head = ctx.capture(['git', 'rev-parse', 'HEAD'])
+        tag = ctx.capture(['git', 'rev-parse', f'v{ctx.openwrt_version}^{{commit}}'])
+        if not head or head != tag:
+            return None
+        return _digest(ctx.openwrt_version, tag)
+    
+    if stage == 'feeds':
+        try:
+            feeds_conf = generate_feeds_conf(ctx)
+        except OSError:
+            return None
+        heads = feed_heads(ctx, parse_feeds(feeds_conf))
+        if None in heads.values():
+            return None
+        return _digest(feeds_conf, heads)
+    
+    if stage == 'config':
+        try:
+            seed = config_model(ctx).render()
+        except ConfigConflict:
+            return None
+        return _digest(seed, ctx.read_stamp('source'), ctx.read_stamp('feeds'))
+    
+    # The generated .config decides what the toolchain and firmware contain;
+    # the toolchain does not care which packages are selected
+    config = Kconfig.load(ctx.path('.config'))
+    if config is None:
+        return None
+    if stage == 'toolchain':
+        return _digest(stage, config.without_packages().render(), ctx.read_stamp('source'))
+    if stage == 'download':
+        if not os.path.isdir(ctx.path('dl')):
+            return None
+        return _digest(stage, config.render(), ctx.read_stamp('source'), ctx.read_stamp('feeds'))
+    if not os.path.isdir(ctx.path('bin', 'targets', ctx.target, ctx.subtarget)):
+        return None
+    return _digest(stage, config.render(), ctx.read_stamp('source'), ctx.read_stamp('feeds'))
+
+def plan_stages(ctx, force=()):
+    """Decide which stages run: [(stage, action, reason)]
+    
+    action is 'run', 'skip', or 'check' for stages whose inputs are produced
+    by an earlier stage that runs; those are decided when they are reached.
+    A forced stage forces all stages after it.
+    """
+    forced = set()
+    for stage in STAGES:
+        if forced or stage in force or 'all' in force:
+            forced.add(stage)
+    
+    plan = []
+    upstream = None
+    for stage in STAGES:
+        if stage in UNSTAMPED_STAGES:
+            action, reason = 'run', 'always'
+        elif stage in forced:
+            action, reason = 'run', 'forced'
+        elif not os.path.isdir(ctx.source_dir):
+            action, reason = 'run', 'no source tree'
+        elif upstream:
+            action, reason = 'check', f'after {upstream}'
+        else:
+            action, reason = stage_action(ctx, stage)
+        if action == 'run' and stage not in UNSTAMPED_STAGES and upstream is None:
+            upstream = stage
+        plan.append((stage, action, reason))
+    return plan
+
+def stage_action(ctx, stage):
+    key = stage_key(ctx, stage)
+    stamp = ctx.read_stamp(stage)
+    if key is not None and key == stamp:
+        return 'skip', 'up to date'
+    return 'run', 'no stamp' if stamp is None else 'inputs changed'
+
+def report_failure(ctx):
+    """Write the failure summary of the command output next to the log and add it to the log"""
+    summary = {'stage': ctx.stage, **ctx.log.summary()}
+    ctx.stats['failure'] = summary
+    path = os.path.join(ctx.output_root, 'logs', f"{ctx.target}_{ctx.subtarget}.failure.json")
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    lines = format_summary(summary)
+    ctx.log.note('\n'.join([f"Build failed in stage {ctx.stage}"] + lines), echo=False)
+    for line in lines:
+        logger.error(line)
+
+def run_pipeline(ctx, force=(), shipper=None):
+    """Run the build stages that are not up to date, returns the output directory
+    
+    Command output is captured in output/logs/<target>_<subtarget>.output.log.gz
+    and, with a shipper, streamed to the web app.
+    """
+    log_dir = os.path.join(ctx.output_root, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    try:
+        os.remove(os.path.join(log_dir, f"{ctx.target}_{ctx.subtarget}.failure.json"))
+    except FileNotFoundError:
+        pass
+    ctx.log = BuildLog(os.path.join(log_dir, f"{ctx.target}_{ctx.subtarget}.output.log.gz"), shipper)
+    if ctx.stage_log:
+        # Records are appended as stages end, start with an empty log
+        open(ctx.stage_log, 'w').close()
+    plan = plan_stages(ctx, force)
+    logger.info("Build plan:")
+    for stage, action, reason in plan:
+        logger.info(f"  {stage:<10} {action:<5} ({reason})")
+    
+    output_dir = None
+    try:
+        for stage, action, _ in plan:
+            if action == 'check':
+                action, reason = stage_action(ctx, stage)
+                logger.info(f"Stage {stage}: {action} ({reason})")
+            if action == 'skip':
+                ctx.record_stage(stage, 'skipped')
+                continue
+            ctx.clear_stamp(stage)
+            with ctx.stage_timer(stage):
+                output_dir = STAGE_FUNCTIONS[stage](ctx)
+            if stage not in UNSTAMPED_STAGES:
+                # Keys are taken after the stage, e.g. the commit it checked out
+                key = stage_key(ctx, stage)
+                if key is not None:
+                    ctx.write_stamp(stage, key)
+    except BaseException:
+        # Do not leave make running in the background after a failure or ^C
+        ctx.stop()
+        report_failure(ctx)
+        raise
+    finally:
+        ctx.log.close()
+        ctx.log = None
+    return output_dir
+
+def parse_target_list(registry, args):
+    """(target, subtarget) pairs of a multi-target run"""
+    configured = [(t['name'], t['subtarget']) for t in registry.targets()]
+    if args.all_targets:
+        return configured
+    
+    targets = []
+    for item in args.targets.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '/' in item:
+            targets.append(tuple(item.split('/', 1)))
+            continue
+        matches = [pair for pair in configured if pair[0] == item]
+        if not matches:
+            raise SystemExit(f"Unknown target {item}, use target/subtarget")
+        targets += matches
+    return list(dict.fromkeys(targets))
+
+def prepare_source_store(worktree_dir, version):
+    """Clone or update the bare OpenWrt repository all worktrees share objects with"""
+    store = os.path.join(worktree_dir, 'openwrt.git')
+    if not os.path.exists(store):
+        logger.info(f"Cloning OpenWrt object store into {store}...")
+        subprocess.run(['git', 'clone', '--bare', OPENWRT_GIT_URL, store], check=True)
+    else:
+        subprocess.run(['git', '-C', store, 'fetch', '--tags', 'origin'], check=True)
+    subprocess.run(['git', '-C', store, 'worktree', 'prune'], check=True)
+    return store
+
+def prepare_worktree(store, worktree_dir, name, version, output_dir):
+    """Check out v<version> in the worktree of one target and link the shared output/"""
+    build_dir = os.path.abspath(os.path.join(worktree_dir, name))
+    source_dir = os.path.join(build_dir, 'openwrt')
+    os.makedirs(build_dir, exist_ok=True)
+    
+    if os.path.exists(os.path.join(source_dir, '.git')):
+        subprocess.run(['git', '-C', source_dir, 'checkout', '--force', '--detach', f'v{version}'], check=True)
+    else:
+        subprocess.run(['git', '-C', store, 'worktree', 'add', '--force', '--detach',
+                        source_dir, f'v{version}'], check=True)
+    
+    # Each tree has its own dl/ of hardlinks into the download store, so
+    # concurrent downloads of the same file do not write to one path
+    dl_link = os.path.join(source_dir, 'dl')
+    if os.path.islink(dl_link):
+        os.remove(dl_link)
+    output_link = os.path.join(build_dir, 'output')
+    if not os.path.lexists(output_link):
+        os.symlink(output_dir, output_link)
+    return build_dir
+
+def run_target_build(args, target, subtarget, build_dir, jobs, log_path, download_cache):
+    """Build one target in its worktree as a child process, return its summary entry"""
+    cmd = [
+        sys.executable, os.path.abspath(__file__),
+        '--target', target,
+        '--subtarget', subtarget,
+        '--openwrt-version', args.openwrt_version,
+        '--version', args.version,
+        '--config-dir', os.path.abspath(args.config_dir),
+        '--jobs', str(jobs),
+        '--source-ready',
+        '--download-cache', download_cache,
+    ]
+    stage_log = f"{os.path.splitext(log_path)[0]}.stages.jsonl"
+    cmd += ['--stage-log', stage_log]
+    if args.repositories:
+        cmd += ['--repositories', os.path.abspath(args.repositories)]
+    for stage in args.force_stage:
+        cmd += ['--force-stage', stage]
+    if args.debug:
+        cmd.append('--debug')
+    
+    logger.info(f"Building {target}/{subtarget} with {jobs} jobs, log: {log_path}")
+    start_time = time.time()
+    with open(log_path, 'w') as log:
+        returncode = subprocess.run(cmd, cwd=build_dir, stdout=log, stderr=subprocess.STDOUT).returncode
+    duration = time.time() - start_time
+    
+    status = 'success' if returncode == 0 else 'failed'
+    logger.info(f"Build for {target}/{subtarget} {status} after {duration:.1f} seconds")
+    
+    stages = []
+    try:
+        with open(stage_log) as f:
+            stages = [json.loads(line) for line in f if line.strip()]
+    except (OSError, ValueError):
+        pass
+    failure = None
+    if returncode != 0:
+        try:
+            with open(os.path.join(os.path.dirname(log_path), f"{target}_{subtarget}.failure.json")) as f:
+                failure = json.load(f)
+        except (OSError, ValueError):
+            pass
+    stats = {}
+    if returncode == 0:
+        try:
+            with open(os.path.join(build_dir, 'output', f"{target}_{subtarget}_{args.version}",
+                                   'build-stats.json')) as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            pass
+    return {
+        'target': target,
+        'subtarget': subtarget,
+        'status': status,
+        'returncode': returncode,
+        'jobs': jobs,
+        'duration': round(duration, 1),
+        'log': log_path,
+        'output_dir': f"output/{target}_{subtarget}_{args.version}" if returncode == 0 else None,
+        'download_cache': stats.get('download_cache'),
+        'ccache': stats.get('ccache'),
+        'stages': stages,
+        'failure': failure,
+    }
+
+def total_download_stats(results):
+    """Download cache figures of all builds of a run added up"""
+    totals = {'hits': 0, 'misses': 0, 'hit_bytes': 0, 'miss_bytes': 0, 'stored': 0, 'linked': 0}
+    for result in results:
+        for key, value in (result.get('download_cache') or {}).items():
+            if key in totals:
+                totals[key] += value
+    lookups = totals['hits'] + totals['misses']
+    totals['hit_rate'] = round(totals['hits'] / lookups, 3) if lookups else None
+    return totals
+
+def build_targets(args, registry):
+    """Build several targets concurrently from worktrees of one shared repository
+    
+    A global job budget (--jobs, default CPU count) is split between the
+    builds running at the same time. Returns the process exit code.
+    """
+    targets = parse_target_list(registry, args)
+    if not targets:
+        logger.error("No targets to build")
+        return 1
+    
+    budget = args.jobs or os.cpu_count() or 1
+    parallel = args.parallel or max(1, budget // MIN_JOBS_PER_BUILD)
+    parallel = max(1, min(parallel, len(targets)))
+    jobs = max(1, budget // parallel)
+    
+    worktree_dir = os.path.abspath(args.worktree_dir)
+    # Targets share their source archives through the store, so there is always one
+    download_cache = download_cache_dir(args, registry) or os.path.abspath('dl-cache')
+    output_dir = os.path.abspath('output')
+    log_dir = os.path.join(output_dir, 'logs')
+    for directory in (worktree_dir, download_cache, log_dir):
+        os.makedirs(directory, exist_ok=True)
+    
+    logger.info(f"Building {len(targets)} targets, {parallel} at a time with {jobs} jobs each")
+    
+    # Git operations on the shared store are serialized, only the builds run concurrently
+    store = prepare_source_store(worktree_dir, args.openwrt_version)
+    build_dirs = {}
+    for target, subtarget in targets:
+        name = f"{target}_{subtarget}"
+        build_dirs[name] = prepare_worktree(store, worktree_dir, name, args.openwrt_version, output_dir)
+    
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        futures = [
+            pool.submit(run_target_build, args, target, subtarget, build_dirs[f"{target}_{subtarget}"],
+                        jobs, os.path.join(log_dir, f"{target}_{subtarget}.log"), download_cache)
+            for target, subtarget in targets
+        ]
+        results = [future.result() for future in futures]
+    
+    summary = {
+        'openwrt_version': args.openwrt_version,
+        'version': args.version,
+        'job_budget': budget,
+        'parallel': parallel,
+        'duration': round(time.time() - start_time, 1),
+        'download_cache': total_download_stats(results),
+        'builds': results,
+    }
+    summary_path = os.path.join(output_dir, 'build-summary.json')
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    
+    logger.info("Build summary:")
+    for result in results:
+        ccache = result.get('ccache')
+        ccache_info = f", ccache hit rate {ccache['hit_rate']:.0%}" if ccache and ccache.get('hit_rate') is not None else ''
+        logger.info(f"  {result['target']}/{result['subtarget']}: {result['status']} "
+                    f"in {result['duration']:.1f}s{ccache_info} ({result['log']})")
+    totals = summary['download_cache']
+    logger.info(f"Download cache: {totals['hits']} hits, {totals['misses']} misses"
+                + (f", hit rate {totals['hit_rate']:.0%}" if totals['hit_rate'] is not None else ''))
+    failed = [result for result in results if result['status'] != 'success']
+    logger.info(f"{len(results) - len(failed)}/{len(results)} builds succeeded, summary saved to {summary_path}")
+    return 1 if failed else 0
+
 def main():
     args = parse_args()
     
     if args.debug:
         logger.setLevel(logging.DEBUG)
     
+    if args.all_targets or args.targets:
+        os.makedirs('output', exist_ok=True)
+        try:
+            sys.exit(build_targets(args, load_config(args.config_dir)))
+        except (subprocess.CalledProcessError, OSError) as e:
+            logger.error(f"Multi-target build failed: {e}")
+            sys.exit(1)
+    
     logger.info(f"Starting OpenWrt build process for {args.target}/{args.subtarget}")
     logger.info(f"OpenWrt version: {args.openwrt_version}")
     logger.info(f"Release version: {args.version}")
     
-    # Create necessary directories
-    os.makedirs('output', exist_ok=True)
-    
     # Load configuration
-    openwrt_config, packages_config = load_config(args.config_dir)
+    registry = load_config(args.config_dir)
+    ctx = BuildContext(registry, args.target, args.subtarget, args.openwrt_version, args.version,
+                       jobs=args.jobs, source_ready=args.source_ready,
+                       repositories=load_repositories(args.repositories),
+                       download_cache=download_cache_dir(args, registry),
+                       stage_log=os.path.abspath(args.stage_log) if args.stage_log else None)
+    
+    shipper = None
+    if args.webhook_url and args.build_id:
+        shipper = LogShipper(args.webhook_url, args.build_id, os.environ.get('WEBHOOK_SECRET'))
     
     # Setup and build
-    setup_openwrt_source(args.openwrt_version)
-    add_custom_package_feeds(packages_config)
-    create_config(openwrt_config, packages_config, args.target, args.subtarget, args.version)
-    build_firmware(openwrt_config, args.target, args.subtarget)
-    output_dir = create_output_directory(args.target, args.subtarget, args.version)
+    try:
+        output_dir = run_pipeline(ctx, force=args.force_stage, shipper=shipper)
+    except (subprocess.CalledProcessError, OSError, RuntimeError, ConfigConflict) as e:
+        logger.error(f"Build failed in stage {ctx.stage}: {e}")
+        sys.exit(1)
     
     logger.info(f"Build for {args.target}/{args.subtarget} completed successfully")
     logger.info(f"Output saved to {output_dir}")
@@ -6,22 +6,54 @@ Create GitHub release and upload firmware assets
 import argparse
 import glob
 import hashlib
+import json
 import logging
 import os
+import random
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 import requests
 import yaml
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from artifacts import MANIFEST_NAME, read_sha256sums  # noqa: E402
 
 logging.basicConfig(level=logging.INFO,
                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('release')
 
+ASSET_SUFFIXES = ('.bin', '.img', '.img.gz', '.itb', '.buildinfo', '.manifest')
+HASH_BUFFER_SIZE = 4 * 1024 * 1024
+DIGEST_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'openwrt-release', 'digests.json')
+
+UPLOAD_WORKERS = 4
+UPLOAD_RETRIES = 5
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+UPLOAD_TIMEOUT = (10, 300)
+PROGRESS_INTERVAL = 10
+WEBHOOK_RETRIES = 3
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Create GitHub release and upload assets')
     parser.add_argument('--version', required=True, help='Release version')
     parser.add_argument('--artifacts-dir', required=True, help='Directory containing build artifacts')
     parser.add_argument('--config-dir', default='./config', help='Configuration directory')
+    parser.add_argument('--hash-workers', type=int, help='Files hashed in parallel (default: CPU count)')
+    parser.add_argument('--digest-cache', default=DIGEST_CACHE,
+                        help='File remembering digests between runs, empty to disable')
+    parser.add_argument('--upload-workers', type=int, default=UPLOAD_WORKERS,
+                        help=f'Assets uploaded in parallel (default: {UPLOAD_WORKERS})')
+    parser.add_argument('--webhook-url', default=os.environ.get('WEBHOOK_URL'),
+                        help='Web app webhook to record the release and its assets (env WEBHOOK_URL)')
+    parser.add_argument('--build-id', default=os.environ.get('BUILD_ID'),
+                        help='Web app build whose artifacts are released (env BUILD_ID)')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Compare serial and parallel checksumming of the artifacts and exit')
     parser.add_argument('--debug', action='store_true', help='Enable debug output')
     return parser.parse_args()
 
@@ -34,27 +66,180 @@ def load_config(config_dir):
     
     return openwrt_config
 
-def create_checksums(artifacts_dir):
-    """Create SHA256 checksums for all firmware files"""
+def find_assets(artifacts_dir):
+    """Sorted paths of the firmware files below artifacts_dir"""
+    paths = []
+    for root, _, files in os.walk(artifacts_dir):
+        for file in files:
+            if file.endswith(ASSET_SUFFIXES):
+                paths.append(os.path.join(root, file))
+    return sorted(paths)
+
+def published_digests(artifacts_dir):
+    """{path: (size or None, sha256)} from the sha256sums and artifacts.json of the builds"""
+    digests = {}
+    for root, _, files in os.walk(artifacts_dir):
+        if 'sha256sums' in files:
+            for name, digest in read_sha256sums(root).items():
+                digests[os.path.normpath(os.path.join(root, name))] = (None, digest)
+        if MANIFEST_NAME in files:
+            try:
+                with open(os.path.join(root, MANIFEST_NAME)) as f:
+                    manifest = json.load(f)
+                for artifact in manifest.get('artifacts', []):
+                    path = os.path.normpath(os.path.join(root, artifact['name']))
+                    digests[path] = (artifact['size'], artifact['sha256'])
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Ignoring unreadable {os.path.join(root, MANIFEST_NAME)}: {e}")
+    return digests
+
+def hash_file(path):
+    """sha256 of a file, read in large blocks into one reused buffer"""
+    sha256 = hashlib.sha256()
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            sha256.update(view[:size])
+    return sha256.hexdigest()
+
+def hash_file_serial(path):
+    """sha256 of a file the way release.py used to compute it, for --benchmark"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(4096), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def hash_files(paths, workers=None):
+    """{path: sha256}, hashed in parallel (hashlib releases the GIL on large blocks)"""
+    if not paths:
+        return {}
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        return dict(zip(paths, pool.map(hash_file, paths)))
+
+class DigestCache:
+    """Digests of earlier runs, valid while a file's size, mtime and inode are unchanged"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if path:
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                pass
+    
+    @staticmethod
+    def _key(st):
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+    
+    def get(self, path, st):
+        entry = self.entries.get(os.path.abspath(path))
+        if entry and entry[:3] == self._key(st):
+            return entry[3]
+        return None
+    
+    def put(self, path, st, digest):
+        self.entries[os.path.abspath(path)] = self._key(st) + [digest]
+    
+    def save(self):
+        if not self.path:
+            return
+        # Entries of deleted files would only accumulate
+        entries = {path: entry for path, entry in self.entries.items() if os.path.exists(path)}
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+def create_checksums(artifacts_dir, cache_path=DIGEST_CACHE, workers=None):
+    """Create SHA256 checksums for all firmware files
+    
+    Digests are taken from the builds' sha256sums and artifacts.json, then
+    from the digest cache; only the remaining files are read, in parallel.
+    """
     checksum_file = os.path.join(artifacts_dir, 'sha256sums.txt')
-    checksums = {}
+    published = published_digests(artifacts_dir)
+    cache = DigestCache(cache_path)
+    digests = {}
+    stats = {}
+    to_hash = []
+    
+    for path in find_assets(artifacts_dir):
+        st = os.stat(path)
+        size, digest = published.get(os.path.normpath(path), (None, None))
+        if digest and size in (None, st.st_size):
+            source = 'published'
+        else:
+            digest = cache.get(path, st)
+            source = 'cached'
+        if digest:
+            digests[path] = digest
+            stats[source] = stats.get(source, 0) + 1
+        else:
+            to_hash.append(path)
+    
+    start_time = time.time()
+    hashed_bytes = 0
+    for path, digest in hash_files(to_hash, workers).items():
+        st = os.stat(path)
+        cache.put(path, st, digest)
+        digests[path] = digest
+        hashed_bytes += st.st_size
+    elapsed = time.time() - start_time
+    cache.save()
     
+    checksums = {}
     with open(checksum_file, 'w') as f:
-        for root, _, files in os.walk(artifacts_dir):
-            for file in files:
-                if file.endswith(('.bin', '.buildinfo', '.manifest')):
-                    file_path = os.path.join(root, file)
-                    sha256 = hashlib.sha256()
-                    with open(file_path, 'rb') as bin_file:
-                        for chunk in iter(lambda: bin_file.read(4096), b''):
-                            sha256.update(chunk)
-                    checksum = sha256.hexdigest()
-                    checksums[file] = checksum
-                    f.write(f"{checksum}  {file}\n")
+        for path in sorted(digests):
+            file = os.path.basename(path)
+            # Only the first file of a name becomes a release asset
+            if file not in checksums:
+                checksums[file] = digests[path]
+                f.write(f"{digests[path]}  {file}\n")
     
     logger.info(f"Created checksums file: {checksum_file}")
+    logger.info(f"Checksums of {len(digests)} files: {stats.get('published', 0)} from sha256sums/artifacts.json, "
+                f"{stats.get('cached', 0)} from the digest cache, {len(to_hash)} hashed "
+                f"({hashed_bytes / 1e6:.1f} MB in {elapsed:.1f} seconds)")
     return checksum_file, checksums
 
+def benchmark_checksums(artifacts_dir, workers=None):
+    """Log the throughput of serial 4 KiB hashing against the parallel hashing"""
+    paths = find_assets(artifacts_dir)
+    total = sum(os.path.getsize(path) for path in paths)
+    if not total:
+        logger.error(f"No firmware files to hash in {artifacts_dir}")
+        return
+    
+    # Read everything once, so both runs hash from the page cache
+    for path in paths:
+        with open(path, 'rb', buffering=0) as f:
+            while f.read(HASH_BUFFER_SIZE):
+                pass
+    
+    start_time = time.time()
+    serial = {path: hash_file_serial(path) for path in paths}
+    serial_time = time.time() - start_time
+    
+    start_time = time.time()
+    parallel = hash_files(paths, workers)
+    parallel_time = time.time() - start_time
+    
+    if serial != parallel:
+        logger.error("Serial and parallel checksums differ")
+        sys.exit(1)
+    logger.info(f"Hashed {len(paths)} files, {total / 1e6:.1f} MB")
+    logger.info(f"Serial, 4 KiB reads: {total / 1e6 / max(serial_time, 1e-9):.1f} MB/s")
+    logger.info(f"Parallel, {HASH_BUFFER_SIZE // (1024 * 1024)} MiB reads, {workers or os.cpu_count()} workers: "
+                f"{total / 1e6 / max(parallel_time, 1e-9):.1f} MB/s")
+
 def create_release_notes(version, openwrt_config, artifacts_dir, checksums):
     """Create release notes markdown file"""
     notes_file = os.path.join(artifacts_dir, 'release_notes.md')
@@ -90,8 +275,219 @@ def create_release_notes(version, openwrt_config, artifacts_dir, checksums):
     logger.info(f"Created release notes: {notes_file}")
     return notes_file
 
-def create_github_release(version, release_notes_file, artifacts_dir):
-    """Create GitHub release and upload assets"""
+class UploadProgress:
+    """Bytes sent by all uploads, logged at most every PROGRESS_INTERVAL seconds"""
+    
+    def __init__(self, total):
+        self.total = total
+        self.sent = 0
+        self.start_time = time.time()
+        self._logged = self.start_time
+        self._lock = threading.Lock()
+    
+    def add(self, size):
+        with self._lock:
+            self.sent += size
+            now = time.time()
+            if now - self._logged < PROGRESS_INTERVAL:
+                return
+            self._logged = now
+        logger.info(f"Uploaded {self.sent / 1e6:.1f} of {self.total / 1e6:.1f} MB "
+                    f"({self.sent / 1e6 / (now - self.start_time):.1f} MB/s)")
+    
+    def rate(self):
+        return self.sent / 1e6 / max(time.time() - self.start_time, 1e-9)
+
+class AssetReader:
+    """File object handed to requests, so an asset is streamed from disk"""
+    
+    def __init__(self, path, progress):
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.progress = progress
+        self.sent = 0
+    
+    def __len__(self):
+        return self.size
+    
+    def read(self, size=-1):
+        data = self.file.read(UPLOAD_BLOCK_SIZE if size is None or size < 0 else size)
+        self.sent += len(data)
+        self.progress.add(len(data))
+        return data
+    
+    def close(self):
+        self.file.close()
+
+def github_session(github_token, pool_size):
+    """Session whose connections are shared by the API calls and the uploads"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'Authorization': f'token {github_token}',
+        'Accept': 'application/vnd.github.v3+json'
+    })
+    return session
+
+def release_assets(artifacts_dir):
+    """{asset name: path} of the files to attach to the release"""
+    assets = {}
+    for path in find_assets(artifacts_dir) + [os.path.join(artifacts_dir, 'sha256sums.txt')]:
+        name = os.path.basename(path)
+        if name in assets:
+            # Release assets are a flat namespace
+            logger.warning(f"Skipping {path}, an asset named {name} comes from {assets[name]}")
+            continue
+        assets[name] = path
+    return assets
+
+def remove_partial_asset(session, assets_url, name):
+    """Delete an asset left behind by an interrupted upload, returns True if it is gone
+    
+    GitHub keeps such an asset (state "starter") under the name, and refuses
+    another upload of that name with 422 already_exists until it is deleted.
+    """
+    url = f"{assets_url}?per_page=100"
+    try:
+        while url:
+            response = session.get(url, timeout=UPLOAD_TIMEOUT)
+            if response.status_code != 200:
+                return False
+            for asset in response.json():
+                if asset['name'] == name:
+                    logger.info(f"Deleting partial upload of {name} (state {asset.get('state')})")
+                    response = session.delete(asset['url'], timeout=UPLOAD_TIMEOUT)
+                    return response.status_code in (204, 404)
+            url = response.links.get('next', {}).get('url')
+    except requests.RequestException as e:
+        logger.debug(f"Could not remove partial upload of {name}: {e}")
+        return False
+    return True
+
+def upload_asset(session, upload_url, assets_url, name, path, progress):
+    """Upload one asset, retrying with exponential backoff; returns GitHub's asset or None"""
+    for attempt in range(UPLOAD_RETRIES):
+        # A failed attempt may have left a partial asset that blocks the name
+        if attempt and not remove_partial_asset(session, assets_url, name):
+            error = f"could not remove the partial upload of {name}"
+            logger.warning(f"Failed to upload asset {name}: {error}")
+            return None
+        reader = AssetReader(path, progress)
+        try:
+            start_time = time.time()
+            response = session.post(
+                upload_url,
+                params={'name': name},
+                headers={'Content-Type': 'application/octet-stream'},
+                data=reader,
+                timeout=UPLOAD_TIMEOUT
+            )
+            if response.status_code in (200, 201):
+                elapsed = max(time.time() - start_time, 1e-9)
+                logger.info(f"Successfully uploaded {name} ({reader.size / 1e6:.1f} MB, "
+                            f"{reader.size / 1e6 / elapsed:.1f} MB/s)")
+                return response.json()
+            error = f"{response.status_code} {response.text}"
+            # Other client errors do not go away by trying again
+            retryable = response.status_code == 429 or (
+                response.status_code == 422 and 'already_exists' in response.text)
+            if response.status_code < 500 and not retryable:
+                logger.warning(f"Failed to upload asset {name}: {error}")
+                return None
+        except requests.RequestException as e:
+            error = str(e)
+        finally:
+            reader.close()
+        # Bytes of the failed attempt do not count as uploaded
+        progress.add(-reader.sent)
+        if attempt + 1 < UPLOAD_RETRIES:
+            delay = 2 ** attempt + random.uniform(0, 1)
+            logger.warning(f"Upload of {name} failed ({error}), retrying in {delay:.1f} seconds")
+            time.sleep(delay)
+    logger.warning(f"Failed to upload asset {name} after {UPLOAD_RETRIES} attempts: {error}")
+    return None
+
+def find_or_create_release(session, releases_url, release_data):
+    """The release of the tag, created if it does not exist yet and updated otherwise"""
+    response = session.get(f"{releases_url}/tags/{release_data['tag_name']}", timeout=UPLOAD_TIMEOUT)
+    if response.status_code == 200:
+        release_info = response.json()
+        logger.info(f"Release {release_data['tag_name']} exists. ID: {release_info['id']}")
+        # Notes and checksums may have changed since the earlier run
+        response = session.patch(f"{releases_url}/{release_info['id']}", json=release_data,
+                                 timeout=UPLOAD_TIMEOUT)
+        if response.status_code != 200:
+            logger.error(f"Failed to update release: {response.status_code} {response.text}")
+            sys.exit(1)
+        return response.json()
+    if response.status_code != 404:
+        logger.error(f"Failed to look up release: {response.status_code} {response.text}")
+        sys.exit(1)
+    
+    response = session.post(releases_url, json=release_data, timeout=UPLOAD_TIMEOUT)
+    if response.status_code not in (200, 201):
+        logger.error(f"Failed to create release: {response.status_code} {response.text}")
+        sys.exit(1)
+    release_info = response.json()
+    logger.info(f"Release created successfully. ID: {release_info['id']}")
+    return release_info
+
+def list_release_assets(session, releases_url, release_id):
+    """{name: asset} of everything attached to a release"""
+    assets = {}
+    url = f"{releases_url}/{release_id}/assets?per_page=100"
+    while url:
+        response = session.get(url, timeout=UPLOAD_TIMEOUT)
+        if response.status_code != 200:
+            logger.error(f"Failed to list release assets: {response.status_code} {response.text}")
+            sys.exit(1)
+        assets.update({asset['name']: asset for asset in response.json()})
+        url = response.links.get('next', {}).get('url')
+    return assets
+
+def asset_is_current(asset, path, digest):
+    """Whether an uploaded asset matches the local file
+    
+    GitHub reports a sha256 digest for assets uploaded since mid 2025; older
+    ones can only be compared by size.
+    """
+    if asset.get('state') != 'uploaded' or asset.get('size') != os.path.getsize(path):
+        return False
+    remote = asset.get('digest') or ''
+    return not remote.startswith('sha256:') or remote[len('sha256:'):] == digest
+
+def delete_asset(session, releases_url, asset):
+    response = session.delete(f"{releases_url}/assets/{asset['id']}", timeout=UPLOAD_TIMEOUT)
+    if response.status_code not in (204, 404):
+        logger.error(f"Failed to delete asset {asset['name']}: {response.status_code} {response.text}")
+        sys.exit(1)
+
+def notify_webhook(webhook_url, version, release_url, assets, build_id=None):
+    """Record the release and its assets in the web app with a release_created event"""
+    event = {'event_type': 'release_created', 'version': version, 'url': release_url, 'assets': assets}
+    if build_id:
+        event['build_id'] = build_id
+    headers = {}
+    if os.environ.get('WEBHOOK_SECRET'):
+        headers['X-Webhook-Secret'] = os.environ['WEBHOOK_SECRET']
+    for attempt in range(WEBHOOK_RETRIES):
+        try:
+            response = requests.post(webhook_url, json=event, headers=headers, timeout=30)
+            if response.status_code == 200:
+                logger.info(f"Recorded release {version} with {len(assets)} assets in the web app")
+                return
+            if response.status_code < 500:
+                break
+        except requests.RequestException as e:
+            logger.debug(f"Webhook request failed: {e}")
+        time.sleep(2 ** attempt)
+    logger.warning(f"Could not record release {version} in the web app")
+
+def create_github_release(version, release_notes_file, artifacts_dir, checksums,
+                          upload_workers=UPLOAD_WORKERS, webhook_url=None, build_id=None):
+    """Create or update the GitHub release and upload the assets it lacks"""
     # Get GitHub token from environment
     github_token = os.environ.get('GITHUB_TOKEN')
     if not github_token:
@@ -104,20 +500,16 @@ def create_github_release(version, release_notes_file, artifacts_dir):
         logger.error("GITHUB_REPOSITORY environment variable not set")
         sys.exit(1)
     
-    # GitHub API endpoints
-    api_url = f"https://api.github.com/repos/{github_repository}"
+    # GitHub API endpoints (GITHUB_API_URL is set by Actions, and on GitHub Enterprise)
+    api_url = f"{os.environ.get('GITHUB_API_URL', 'https://api.github.com')}/repos/{github_repository}"
     releases_url = f"{api_url}/releases"
     
     # Read release notes
     with open(release_notes_file, 'r') as f:
         release_notes = f.read()
     
-    # Create release
-    logger.info(f"Creating GitHub release for version {version}")
-    headers = {
-        'Authorization': f'token {github_token}',
-        'Accept': 'application/vnd.github.v3+json'
-    }
+    logger.info(f"Publishing GitHub release for version {version}")
+    session = github_session(github_token, upload_workers)
     
     release_data = {
         'tag_name': f'v{version}',
@@ -127,39 +519,46 @@ def create_github_release(version, release_notes_file, artifacts_dir):
         'prerelease': '-' in version  # Treat versions with hyphen as pre-releases
     }
     
-    response = requests.post(releases_url, headers=headers, json=release_data)
-    if response.status_code not in (200, 201):
-        logger.error(f"Failed to create release: {response.status_code} {response.text}")
-        sys.exit(1)
-    
-    release_info = response.json()
-    release_id = release_info['id']
+    release_info = find_or_create_release(session, releases_url, release_data)
     upload_url = release_info['upload_url'].split('{')[0]
+    assets_url = f"{releases_url}/{release_info['id']}/assets"
     
-    logger.info(f"Release created successfully. ID: {release_id}")
+    # Compare with what an earlier run attached: unchanged assets are kept,
+    # changed, broken and stale ones deleted, and only the rest uploaded
+    assets = release_assets(artifacts_dir)
+    digests = {name: checksums.get(name) or hash_file(path) for name, path in assets.items()}
+    existing = list_release_assets(session, releases_url, release_info['id'])
+    current = {}
+    for name, asset in existing.items():
+        if name in assets and asset_is_current(asset, assets[name], digests[name]):
+            current[name] = asset
+            continue
+        logger.info(f"Deleting {'outdated' if name in assets else 'stale'} asset {name}")
+        delete_asset(session, releases_url, asset)
+    missing = [name for name in assets if name not in current]
     
-    # Upload assets
-    for root, _, files in os.walk(artifacts_dir):
-        for file in files:
-            if file.endswith(('.bin', '.buildinfo', '.manifest', 'sha256sums.txt')):
-                file_path = os.path.join(root, file)
-                logger.info(f"Uploading asset: {file}")
-                
-                with open(file_path, 'rb') as f:
-                    file_data = f.read()
-                
-                headers['Content-Type'] = 'application/octet-stream'
-                asset_url = f"{upload_url}?name={file}"
-                response = requests.post(
-                    asset_url,
-                    headers=headers,
-                    data=file_data
-                )
-                
-                if response.status_code not in (200, 201):
-                    logger.warning(f"Failed to upload asset {file}: {response.status_code} {response.text}")
-                else:
-                    logger.info(f"Successfully uploaded {file}")
+    # Upload assets, streamed from disk over the session's pooled connections
+    progress = UploadProgress(sum(os.path.getsize(assets[name]) for name in missing))
+    logger.info(f"Uploading {len(missing)} of {len(assets)} assets, {progress.total / 1e6:.1f} MB, "
+                f"{upload_workers} at a time")
+    with ThreadPoolExecutor(max_workers=upload_workers) as pool:
+        uploaded = dict(zip(missing, pool.map(
+            lambda name: upload_asset(session, upload_url, assets_url, name, assets[name], progress), missing)))
+    
+    failed = [name for name, asset in uploaded.items() if asset is None]
+    logger.info(f"Uploaded {len(missing) - len(failed)} assets, {progress.sent / 1e6:.1f} MB "
+                f"at {progress.rate():.1f} MB/s")
+    if failed:
+        logger.error(f"Failed to upload {len(failed)} assets: {', '.join(failed)}")
+        sys.exit(1)
+    current.update(uploaded)
+    
+    if webhook_url:
+        notify_webhook(webhook_url, version, release_info['html_url'], [
+            {'name': name, 'size': current[name]['size'], 'sha256': digests[name],
+             'url': current[name].get('browser_download_url')}
+            for name in assets
+        ], build_id)
     
     logger.info(f"Release process completed for version {version}")
     return release_info['html_url']
@@ -170,17 +569,22 @@ def main():
     if args.debug:
         logger.setLevel(logging.DEBUG)
     
+    if args.benchmark:
+        benchmark_checksums(args.artifacts_dir, args.hash_workers)
+        return
+    
     logger.info(f"Starting release process for version {args.version}")
     
     # Load configuration
     openwrt_config = load_config(args.config_dir)
     
     # Process artifacts
-    checksum_file, checksums = create_checksums(args.artifacts_dir)
+    checksum_file, checksums = create_checksums(args.artifacts_dir, args.digest_cache, args.hash_workers)
     release_notes_file = create_release_notes(args.version, openwrt_config, args.artifacts_dir, checksums)
     
-    # Create GitHub release
-    release_url = create_github_release(args.version, release_notes_file, args.artifacts_dir)
+    # Create or update the GitHub release
+    release_url = create_github_release(args.version, release_notes_file, args.artifacts_dir, checksums,
+                                        args.upload_workers, args.webhook_url, args.build_id)
     
     logger.info(f"Release available at: {release_url}")
 
@@ -0,0 +1,24 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The app creates its tables at import, point it at a scratch database first
+_db_dir = tempfile.mkdtemp(prefix='openwrt-builder-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    with app_module.app.app_context():
+        yield app_module.app
+        app_module.db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
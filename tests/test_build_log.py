@@ -0,0 +1,37 @@
+import models
+from app import append_build_log, db
+
+
+def _legacy_build(build_id, logs):
+    build = models.Build(build_id=build_id, target='x86', subtarget='64', profile='generic',
+                         version='1.0', openwrt_version='22.03.3', status='in_progress', logs=logs)
+    db.session.add(build)
+    db.session.commit()
+    return build
+
+
+def test_legacy_log_is_kept_after_the_first_append(app):
+    build = _legacy_build('legacy-log', 'old output\n')
+    assert build.tail_log(1024) == (b'old output\n', 0)
+
+    append_build_log(build, 'new output\n')
+    db.session.commit()
+
+    assert build.read_log() == (b'old output\nnew output\n', 22)
+    assert build.tail_log(11) == (b'new output\n', 11)
+    assert build.current_log_size() == 22
+    assert build.logs is None
+
+
+def test_legacy_log_is_not_appended_twice(client):
+    _legacy_build('legacy-resend', 'line 1\n')
+
+    # Older reporters resend the whole log with every status update
+    response = client.post('/api/webhook', json={
+        'event_type': 'build_status', 'build_id': 'legacy-resend', 'status': 'in_progress',
+        'logs': 'line 1\nline 2\n'
+    })
+    assert response.status_code == 200
+
+    build = models.Build.query.filter_by(build_id='legacy-resend').one()
+    assert build.read_log() == (b'line 1\nline 2\n', 14)
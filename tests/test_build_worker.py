@@ -0,0 +1,54 @@
+import os
+
+import models
+from app import db
+from build_worker import BuildWorker, TreeLock
+
+
+def _pending_build(build_id, target='x86', subtarget='64'):
+    build = models.Build(build_id=build_id, target=target, subtarget=subtarget, profile='generic',
+                         version='1.0', openwrt_version='22.03.3', status='pending')
+    db.session.add(build)
+    db.session.commit()
+    return build
+
+
+def _log(build_id):
+    build = models.Build.query.filter_by(build_id=build_id).one()
+    return build.status, build.read_log()[0].decode()
+
+
+def test_builds_of_a_target_share_one_locked_tree(app, tmp_path):
+    _pending_build('tree-a')
+    _pending_build('tree-b')
+    worker = BuildWorker(concurrency=2, work_dir=str(tmp_path),
+                         command='{python} -c "import os; print(os.getcwd())"')
+
+    build, tree_lock = worker.claim()
+    assert build.build_id == 'tree-a'
+    # The other build of the target waits for the tree
+    assert worker.claim() is None
+    worker.start(build, tree_lock)
+    worker.run(once=True)
+
+    tree = worker.tree_dir('x86', '64')
+    for build_id in ('tree-a', 'tree-b'):
+        status, log = _log(build_id)
+        assert status == 'success'
+        assert tree in log
+    assert not os.listdir(tmp_path / 'builds')
+    assert TreeLock(tree).acquire()
+
+
+def test_build_that_cannot_start_fails_at_once(app, tmp_path):
+    _pending_build('no-start', target='ramips', subtarget='mt7621')
+    worker = BuildWorker(concurrency=1, work_dir=str(tmp_path), command=str(tmp_path / 'missing'))
+
+    worker.start(*worker.claim())
+
+    status, log = _log('no-start')
+    assert status == 'failed'
+    assert 'Could not start build' in log
+    assert not worker.jobs_running
+    assert not os.listdir(tmp_path / 'builds')
+    assert TreeLock(worker.tree_dir('ramips', 'mt7621')).acquire()
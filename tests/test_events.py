@@ -0,0 +1,75 @@
+import queue
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select, update
+
+import events
+import models
+from app import db
+
+
+def post_log(client, build_id, data):
+    response = client.post('/api/webhook', json={'event_type': 'build_log', 'build_id': build_id, 'data': data})
+    assert response.status_code == 200
+
+
+def age_all_events():
+    db.session.execute(update(models.BuildEvent).values(created_at=datetime.utcnow() - 2 * events.RETENTION))
+    db.session.commit()
+
+
+def test_event_ids_keep_growing_after_prune(app, client):
+    client.post('/api/webhook', json={'event_type': 'build_status', 'build_id': 'prune-ids', 'status': 'in_progress'})
+    post_log(client, 'prune-ids', 'first\n')
+    newest = events.latest_event_id()
+
+    age_all_events()
+    events.prune()
+    db.session.commit()
+    post_log(client, 'prune-ids', 'second\n')
+
+    assert events.latest_event_id() > newest
+
+
+def test_events_are_delivered_after_everything_was_pruned(app, client):
+    client.post('/api/webhook', json={'event_type': 'build_status', 'build_id': 'prune-live', 'status': 'in_progress'})
+    build = db.session.execute(select(models.Build).filter_by(build_id='prune-live')).scalar_one()
+    post_log(client, 'prune-live', 'before\n')
+
+    broker = events.EventBroker(app)
+    subscriber = broker.subscribe(build_id=build.id, kinds=('log',))
+    try:
+        age_all_events()
+        # Delete the newest event as well, as on a table pruned by an older version
+        db.session.execute(delete(models.BuildEvent))
+        db.session.commit()
+        post_log(client, 'prune-live', 'after\n')
+
+        event_id, message = subscriber.queue.get(timeout=5)
+        assert 'after' in message
+        assert event_id > broker._start_id
+    finally:
+        broker.unsubscribe(subscriber)
+
+
+def test_prune_keeps_the_newest_event(app, client):
+    client.post('/api/webhook', json={'event_type': 'build_status', 'build_id': 'prune-keep', 'status': 'in_progress'})
+    post_log(client, 'prune-keep', 'only\n')
+    newest = events.latest_event_id()
+
+    age_all_events()
+    events.prune()
+    db.session.commit()
+
+    remaining = db.session.execute(select(models.BuildEvent.id)).scalars().all()
+    assert remaining == [newest]
+
+
+def test_streams_over_the_limit_are_turned_away(app, client, monkeypatch):
+    monkeypatch.setattr(events, 'MAX_STREAMS', 0)
+
+    response = client.get('/api/builds/stream')
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(events.FULL_RETRY // 1000)
+    assert response.get_data(as_text=True) == f"retry: {events.FULL_RETRY}\n\n"